@@ -0,0 +1,855 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Bruno Perriot <bperriot@gmail.com>
+# This file is released under the terms of the MIT license.
+
+"""Latency benchmarks for the per-keystroke code of python_indent.py.
+
+Each scenario builds a synthetic worst case view, then times a single call
+of get_new_line_indent, previous_keyword_lookup or PythonDeindenter.on_modified
+many times. The median and 99th percentile latencies are printed, and saved
+to a JSON results file to compare runs between commits:
+
+    $ python bench_python_indent.py --output before.json
+    $ python bench_python_indent.py --output after.json --compare before.json
+
+An editing session recorded with the trace_file setting is replayed with:
+
+    $ python bench_python_indent.py --trace ~/python_indent_trace.jsonl
+
+The throughput and accuracy of the rules on the python files of a directory
+(the standard library by default), compared to the indentation derived from
+the tokenize module, are measured with:
+
+    $ python bench_python_indent.py --corpus [DIR]
+
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import subprocess
+import sys
+import tokenize
+import zlib
+from bisect import bisect_right
+from functools import partial
+from timeit import default_timer
+
+from python_indent import advance_line_state
+from python_indent import check_lines
+from python_indent import deindent_keywords
+from python_indent import Document
+from python_indent import EMPTY_LINE_STATE
+from python_indent import get_line_state_cache
+from python_indent import get_new_line_indent
+from python_indent import INDEX_SLICE
+from python_indent import IndentChecker
+from python_indent import IndexScheduler
+from python_indent import iter_python_files
+from python_indent import invalidate_line_states
+from python_indent import line_state_caches
+from python_indent import line_breaks
+from python_indent import LineStateTracker
+from python_indent import NewPythonLine
+from python_indent import paste_edit
+from python_indent import previous_keyword_lookup
+from python_indent import PythonDeindenter
+from python_indent import reindent_lines
+from python_indent import text_hash
+
+
+class BenchRegion(object):
+    """Minimal sublime.Region."""
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def empty(self):
+        return self.a == self.b
+
+    def __getitem__(self, i):
+        return (self.a, self.b)[i]
+
+
+class BenchSelection(list):
+    """Minimal sublime.RegionSet."""
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(BenchRegion(region[0], region[1]))
+
+
+class BenchSettings(dict):
+    """Minimal sublime.Settings."""
+    def add_on_change(self, key, on_change):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+
+class BenchView(object):
+    """Minimal read-only sublime.View over a string.
+
+    Replacements are not applied, so that the same modification can be
+    timed repeatedly.
+    """
+    ids = Document.ids
+
+    def __init__(self, text, cursor=None, command=None, tab_size=4):
+        self.text = text
+        self.id_ = next(self.ids)
+        self.settings_ = BenchSettings(tab_size=tab_size)
+        self.line_starts = [0] + line_breaks(text)
+        if cursor is None:
+            cursor = len(text)
+        self.sel_ = BenchSelection([BenchRegion(cursor, cursor)])
+        self.command = command or (None, None, 1)
+
+    def id(self):
+        return self.id_
+
+    def buffer_id(self):
+        return self.id_
+
+    def size(self):
+        return len(self.text)
+
+    def settings(self):
+        return self.settings_
+
+    def sel(self):
+        return self.sel_
+
+    def score_selector(self, point, selector):
+        return 1
+
+    def line(self, point):
+        if not isinstance(point, int):
+            point = point[0]
+        row = bisect_right(self.line_starts, point) - 1
+        begin = self.line_starts[row]
+        end = self.text.find('\n', begin)
+        return BenchRegion(begin, len(self.text) if end == -1 else end)
+
+    def substr(self, region):
+        return self.text[region[0]:region[1]]
+
+    def command_history(self, index, modifying_only):
+        return self.command
+
+    def begin_edit(self):
+        return None
+
+    def end_edit(self, edit):
+        pass
+
+    def replace(self, edit, region, string):
+        pass
+
+
+class ReplayView(Document, BenchView):
+    """Editable sublime.View over a string, to replay editing sessions."""
+    def __init__(self, text, cursor=None, tab_size=4):
+        Document.__init__(self, text, tab_size)
+        self.settings_ = BenchSettings(tab_size=tab_size)
+        if cursor is None:
+            cursor = len(text)
+        self.sel_ = BenchSelection([BenchRegion(cursor, cursor)])
+        self.command = (None, None, 1)
+
+    def line_endings(self):
+        return 'Unix'
+
+    def insert(self, edit, point, string):
+        self._edit(point, point, string)
+        return len(string)
+
+    def erase(self, edit, region):
+        self._edit(region[0], region[1], '')
+
+    def replace(self, edit, region, string):
+        self._edit(region[0], region[1], string)
+
+    def _edit(self, begin, end, string):
+        self.edit(begin, end, string)
+        delta = len(string) - (end - begin)
+
+        # move the selections as sublime text does
+        def move(point):
+            if point < begin:
+                return point
+            if point >= end:
+                return point + delta
+            return begin + min(point - begin, len(string))
+        self.sel_[:] = [BenchRegion(move(r.a), move(r.b)) for r in self.sel_]
+
+
+def replay(view, script, listeners=None):
+    """Type script in the ReplayView view, as with sublime text.
+
+    A new line character runs the new_python_line command, '\\b' deletes
+    the character before the cursors, and other characters are inserted at
+    the cursors. After each of them, on_modified is called on each of the
+    listeners (by default a PythonDeindenter and a LineStateTracker).
+    """
+    if listeners is None:
+        listeners = [PythonDeindenter(), LineStateTracker()]
+    new_python_line = NewPythonLine()
+    new_python_line.view = view
+    typed = ''
+    for c in script:
+        if c == '\n':
+            new_python_line.run(None)
+            view.command = ('new_python_line', {}, 1)
+            typed = ''
+        elif c == '\b':
+            for region in reversed(view.sel()):
+                if region.empty():
+                    view.erase(None, (max(0, region.a - 1), region.a))
+                else:
+                    view.erase(None, (region.begin(), region.end()))
+            view.command = ('left_delete', None, 1)
+            typed = ''
+        else:
+            for region in reversed(view.sel()):
+                view.replace(None, (region.begin(), region.end()), c)
+            # consecutive characters are one insert command
+            typed += c
+            view.command = ('insert', {'characters': typed}, 1)
+        for listener in listeners:
+            listener.on_modified(view)
+    return view.text
+
+
+def replay_trace(events):
+    """Replay the events of a trace file (see TraceRecorder).
+
+    Each recorded call is run again on a ReplayView, after its modification
+    of the buffer (delta) is applied.
+
+    Return
+    ------
+    (latencies, live, diverged): op -> sorted latencies of the replayed
+    calls, in milliseconds; op -> sorted latencies recorded in the trace;
+    number of calls whose buffer before or after the call does not match
+    the recorded hashes.
+    """
+    latencies = {}
+    live = {}
+    diverged = 0
+    views = {}
+    deindenter = PythonDeindenter()
+    new_python_line = NewPythonLine()
+    for event in events:
+        op = event['op']
+        if op == 'start':
+            # view ids are reused by another session
+            views = {}
+            continue
+        if op == 'view':
+            text = zlib.decompress(base64.b64decode(event['text']))
+            views[event['view']] = ReplayView(text.decode('utf-8'),
+                                              tab_size=event['tab_size'])
+            continue
+        view = views.get(event['view'])
+        if view is None:
+            continue
+        begin, end, text = event['delta']
+        if begin != end or text:
+            view.replace(None, (begin, end), text)
+            # as LineStateTracker
+            invalidate_line_states(view, begin)
+        view.sel_[:] = [BenchRegion(a, b) for a, b in event['sel']]
+        if text_hash(view.text) != event['hash']:
+            diverged += 1
+
+        if op == 'new_line':
+            new_python_line.view = view
+            kwargs = dict((str(k), v) for k, v in event['input'].items())
+            start = default_timer()
+            new_python_line.run(None, **kwargs)
+        else:
+            view.command = tuple(event['input'])
+            start = default_timer()
+            deindenter.on_modified(view)
+        latencies.setdefault(op, []).append(
+            (default_timer() - start) * 1000)
+        live.setdefault(op, []).append(event['ms'])
+        if text_hash(view.text) != event['after']:
+            diverged += 1
+    for samples in list(latencies.values()) + list(live.values()):
+        samples.sort()
+    return latencies, live, diverged
+
+
+def format_trace_results(latencies, live):
+    """Return the latency distributions of a replayed trace as a table."""
+    lines = ['%-10s %8s %10s %10s %10s %10s %12s'
+             % ('op', 'calls', 'median', 'p90', 'p99', 'max',
+                'live median')]
+    for op in sorted(latencies):
+        samples = latencies[op]
+        lines.append('%-10s %8d %10.3f %10.3f %10.3f %10.3f %12.3f'
+                     % (op, len(samples), percentile(samples, 50),
+                        percentile(samples, 90), percentile(samples, 99),
+                        samples[-1], percentile(live[op], 50)))
+    return '\n'.join(lines) + '\n(milliseconds)'
+
+
+## scenarios
+
+def new_line(text, cold=False):
+    """Time get_new_line_indent at the end of text.
+
+    A keystroke invalidates the cached line states after the cursor; with
+    cold, the whole cache of the view is dropped before each call.
+    """
+    view = BenchView(text)
+    cursor = len(text)
+
+    def run():
+        if cold:
+            line_state_caches.pop(view.id(), None)
+        else:
+            invalidate_line_states(view, cursor)
+        get_new_line_indent(view, cursor)
+    return run
+
+
+def keyword_lookup(text, keywords, ignore):
+    """Time previous_keyword_lookup at the end of text."""
+    view = BenchView(text)
+    cursor = len(text)
+
+    def run():
+        previous_keyword_lookup(view, cursor, keywords, ignore)
+    return run
+
+
+def deindent(text, characters):
+    """Time PythonDeindenter.on_modified after characters were typed."""
+    view = BenchView(text, command=('insert', {'characters': characters}, 1))
+    listener = PythonDeindenter()
+
+    def run():
+        listener.on_modified(view)
+    return run
+
+
+def paste(text, pasted):
+    """Time the reindentation of pasted at the end of text."""
+    view = BenchView(text)
+    region = BenchRegion(len(text), len(text))
+
+    def run():
+        invalidate_line_states(view, len(text))
+        paste_edit(view, region, pasted)
+    return run
+
+
+def indent_markers(text):
+    """Time the check of the misindented lines after a modification of the
+    middle line of text."""
+    document = Document(text)
+    checker = IndentChecker(4)
+    last_row = document.rowcol(document.size())[0]
+    checker.update(document, 0, last_row)
+
+    def run():
+        checker.update(document, last_row // 2, last_row // 2)
+    return run
+
+
+def index_slice(text):
+    """Time a slice of the background indexing of a view, from its start:
+    the longest the indexing blocks the main thread."""
+    view = BenchView(text)
+    scheduler = IndexScheduler()
+
+    def run():
+        line_state_caches.pop(view.id(), None)
+        scheduler.index(view, default_timer() + INDEX_SLICE)
+    return run
+
+
+def deep_blocks(depth=100):
+    return ''.join('    ' * i + 'if x%d:\n' % i for i in range(depth)) + \
+        '    ' * depth + 'pass\n'
+
+
+def deep_brackets(depth=200):
+    return 'x = ' + ''.join('f%d(' % i for i in range(depth))
+
+
+def long_continuation(lines=1000):
+    return 'values = [\n' + ''.join('    %d, "%d",\n' % (i, i)
+                                     for i in range(lines))
+
+
+def quote_heavy(lines=200, width=2000):
+    chunk = r"""'a\'"(' "b\"')" """
+    line = '    ' + chunk * (width // len(chunk)) + ',\n'
+    return 'call(\n' + line * lines + '    x'
+
+
+def long_block(lines=1010):
+    """A block body longer than the former lookup limit of 1000 lines."""
+    return 'if x:\n    while y:\n' + '        z += 1\n' * lines + '    else:'
+
+
+SCENARIOS = [
+    ('deep_blocks_new_line', lambda: new_line(deep_blocks())),
+    ('deep_blocks_new_line_cold', lambda: new_line(deep_blocks(), True)),
+    ('deep_blocks_deindent',
+     lambda: deindent(deep_blocks() + '    ' * 99 + 'else:', ':')),
+    ('deep_brackets_new_line', lambda: new_line(deep_brackets())),
+    ('long_continuation_new_line', lambda: new_line(long_continuation())),
+    ('long_continuation_new_line_cold',
+     lambda: new_line(long_continuation(), True)),
+    ('quote_heavy_new_line', lambda: new_line(quote_heavy())),
+    ('quote_heavy_new_line_cold', lambda: new_line(quote_heavy(), True)),
+    ('long_block_keyword_lookup',
+     lambda: keyword_lookup(long_block(), ['if', 'except', 'for', 'while'],
+                            ['elif'])),
+    ('long_block_deindent', lambda: deindent(long_block(), ':')),
+    ('mixed_code_paste',
+     lambda: paste(deep_blocks(10), mixed_code(200))),
+    ('mixed_code_indent_markers', lambda: indent_markers(mixed_code())),
+    ('mixed_code_index_slice', lambda: index_slice(mixed_code())),
+]
+
+
+def mixed_code(blocks=1000):
+    """Code mixing blocks, continuation lines and docstrings."""
+    block = (
+        'class C%d(object):\n'
+        '    """Docstring\n'
+        '\n'
+        '    with (brackets\n'
+        '    """\n'
+        '    def f(self, a,\n'
+        '          b=[1, 2,\n'
+        '             3]):\n'
+        '        # comment\n'
+        '        if a:\n'
+        '            return {"a": (a,\n'
+        '                          b)}\n'
+        '        elif b:\n'
+        '            pass\n'
+        '        else:\n'
+        '            x = call(a, b) + \\\n'
+        '                1\n'
+        '\n')
+    return ''.join(block % i for i in range(blocks))
+
+
+## measure
+
+def percentile(samples, p):
+    """Return the p-th percentile of the sorted list samples."""
+    index = int(round(p / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+def measure(run, repeat, warmup=5):
+    """Return the sorted latencies of repeat calls of run, in microseconds."""
+    for _ in range(warmup):
+        run()
+    samples = []
+    for _ in range(repeat):
+        start = default_timer()
+        run()
+        samples.append((default_timer() - start) * 1e6)
+    samples.sort()
+    return samples
+
+
+def run_benchmarks(repeat=200, names=None):
+    """Run the scenarios and return a JSON serializable dict of results."""
+    results = {}
+    for name, scenario in SCENARIOS:
+        if names and name not in names:
+            continue
+        samples = measure(scenario(), repeat)
+        results[name] = {
+            'median_us': round(percentile(samples, 50), 2),
+            'p99_us': round(percentile(samples, 99), 2),
+            'min_us': round(samples[0], 2),
+        }
+    return results
+
+
+# memory budget of the line states of a view, in bytes per line of
+# mixed_code, where a third of the lines continue a bracket or a string;
+# typical code (the standard library) uses about 30 bytes per line
+LINE_STATE_BYTES_BUDGET = 112
+
+
+def _deep_size(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(_deep_size(key, seen) + _deep_size(value, seen)
+                    for key, value in obj.items())
+    return size
+
+
+def line_state_bytes_per_line(text):
+    """Return the memory used by the line states of text, per line.
+
+    The memory is measured with tracemalloc when available (python 3),
+    otherwise estimated with sys.getsizeof.
+    """
+    view = BenchView(text)
+    line_count = len(view.line_starts)
+    last_line = view.line_starts[-1]
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            # no time budget: all the lines are scanned
+            get_line_state_cache(view).line_state(view, last_line)
+            used = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+    else:
+        get_line_state_cache(view).line_state(view, last_line)
+        used = _deep_size(line_state_caches[view.id()], set())
+        used += sum(_deep_size(value, set()) for value
+                    in vars(line_state_caches[view.id()]).values())
+    line_state_caches.pop(view.id(), None)
+    return float(used) / line_count
+
+
+def git_revision():
+    """Return the current git commit of the repository, or None."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_results(results, previous=None):
+    """Return the results as a text table, compared to previous results."""
+    lines = ['%-34s %12s %12s' % ('scenario', 'median (us)', 'p99 (us)')]
+    for name in sorted(results):
+        line = '%-34s %12.1f %12.1f' % (name, results[name]['median_us'],
+                                        results[name]['p99_us'])
+        if previous and name in previous:
+            line += '   x%.2f' % (results[name]['median_us']
+                                  / max(previous[name]['median_us'], 1e-3))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+## corpus
+
+# kinds of lines whose new line indentation is derived from the tokens
+CORPUS_KINDS = ('block', 'statement', 'stop', 'visual', 'hanging')
+# first words of the statements ending a block
+STOP_WORDS = frozenset(('return', 'raise', 'pass', 'continue', 'break'))
+# number of mismatches kept by corpus_benchmark
+MAX_MISMATCHES = 20
+
+
+def read_source(path):
+    """Return the text of a python file, or None if it is not decodable or
+    indented with tabs."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if bytes is not str:
+        try:
+            data = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    text = data.replace('\r\n', '\n').replace('\r', '\n')
+    if '\n\t' in text or text.startswith('\t'):
+        return None
+    return text
+
+
+def tokenize_expectations(text, tab_size=4):
+    """Return {row: (kind, indent)}, the indentation of a new line inserted
+    after the rows of text, where the tokens of text determine it.
+
+    kind is:
+        block: the row ends a statement opening a block, indented by
+            tab_size.
+        statement: the row ends another statement followed by a statement
+            at the same level.
+        stop: the row ends a return, raise, pass, continue or break
+            statement followed by a statement one level lower.
+        visual: the row ends with a bracket or an element (',') of a
+            bracket followed by code on its line; indent is the column of
+            that code.
+        hanging: the row ends with a bracket or an element of a bracket
+            ending its line; indent is the indentation of the line
+            following the bracket.
+
+    The other rows are left out: rows followed by a dedent the rules cannot
+    guess, by a deindented keyword ('else', 'except'...) or by a closing
+    bracket, rows ending in the middle of an element, blank and comment
+    rows, rows continued by a backslash or a string.
+
+    Raise tokenize.TokenError, SyntaxError or IndentationError if text is
+    not valid python.
+    """
+    lines = [line + '\n' for line in text.split('\n')]
+    tokens = tokenize.generate_tokens(partial(next, iter(lines), ''))
+    expectations = {}
+    # rows ending a statement, waiting for the next one: (row, kind, indent)
+    statements = []
+    # open brackets: [row, visual column, hanging indent, waiting rows]
+    brackets = []
+    # first token of each row
+    first_tokens = {}
+    start = None
+    # first token of the statement, last token outside of the brackets, and
+    # last token
+    first_word = last = previous = None
+    for ttype, string, (srow, scol), end, line in tokens:
+        if ttype == tokenize.ENDMARKER:
+            break
+        if ttype in (tokenize.INDENT, tokenize.DEDENT, tokenize.COMMENT):
+            continue
+        row = srow - 1
+        if ttype == tokenize.NL:
+            blank = not line.strip() or line.lstrip().startswith('#')
+            if brackets and not blank:
+                bracket = brackets[-1]
+                if previous not in (',', '(', '[', '{'):
+                    pass
+                elif bracket[1] is not None:
+                    expectations[row] = ('visual', bracket[1])
+                elif bracket[2] is not None:
+                    expectations[row] = ('hanging', bracket[2])
+                else:
+                    bracket[3].append(row)
+            continue
+        if ttype == tokenize.NEWLINE:
+            if last == ':':
+                kind = 'block'
+            elif first_word in STOP_WORDS:
+                kind = 'stop'
+            else:
+                kind = 'statement'
+            statements.append((row, kind, start))
+            start = first_word = last = None
+            continue
+
+        if row not in first_tokens:
+            first_tokens[row] = string
+            if start is None:
+                for stmt_row, kind, indent in statements:
+                    if kind == 'block':
+                        indent += tab_size
+                    elif kind == 'stop':
+                        indent -= tab_size
+                    if scol == indent and string not in deindent_keywords:
+                        expectations[stmt_row] = (kind, scol)
+                del statements[:]
+            if brackets:
+                bracket = brackets[-1]
+                if (bracket[1] is None and bracket[2] is None
+                        and string not in ')]}'):
+                    bracket[2] = scol
+                    for waiting in bracket[3]:
+                        expectations[waiting] = ('hanging', scol)
+        if brackets and brackets[-1][1] is None and brackets[-1][0] == row:
+            # first token following the bracket on its line
+            brackets[-1][1] = scol
+        if start is None:
+            start = scol
+            first_word = string
+        previous = string
+        if ttype == tokenize.OP and string in '([{':
+            brackets.append([row, None, None, []])
+            continue
+        if ttype == tokenize.OP and string in ')]}':
+            bracket = brackets.pop()
+            if bracket[0] == row and bracket[1] == scol:
+                bracket[1] = None
+        if not brackets:
+            last = string
+
+    # a closing bracket does not follow the indentation of its contents
+    for row in list(expectations):
+        if (expectations[row][0] in ('visual', 'hanging')
+                and first_tokens.get(row + 1, ')') in ')]}'):
+            del expectations[row]
+    return expectations
+
+
+def corpus_benchmark(paths, tab_size=4):
+    """Run the indentation rules over the python files found in paths.
+
+    Return
+    ------
+    dict, JSON serializable:
+        'files', 'skipped', 'lines': number of files read, of files
+            skipped (not decodable, indented with tabs or invalid), and
+            of lines of the files read,
+        'lines_per_second': {pass: lines per second} of the new line
+            indentation of each line (new_line), check_lines (check) and
+            reindent_lines (reindent),
+        'agreement': {kind: [lines, agreeing lines]} of the new line
+            indentation with tokenize_expectations,
+        'mismatches': first MAX_MISMATCHES disagreements, as
+            [path, line number, kind, expected, found].
+    """
+    timers = dict((name, 0.0) for name in ('new_line', 'check', 'reindent'))
+    agreement = dict((kind, [0, 0]) for kind in CORPUS_KINDS)
+    mismatches = []
+    files = skipped = line_count = 0
+    for path in iter_python_files(paths):
+        text = read_source(path)
+        try:
+            expectations = (text is not None
+                            and tokenize_expectations(text, tab_size))
+        except (tokenize.TokenError, SyntaxError):
+            expectations = None
+        if not expectations:
+            skipped += 1
+            continue
+        files += 1
+        lines = text.split('\n')
+        line_count += len(lines)
+
+        start = default_timer()
+        indents = []
+        state = EMPTY_LINE_STATE
+        for row, line in enumerate(lines):
+            state, indent = advance_line_state(line, row, state, tab_size)
+            indents.append(indent)
+        timers['new_line'] += default_timer() - start
+        start = default_timer()
+        for misindented in check_lines(lines, tab_size):
+            pass
+        timers['check'] += default_timer() - start
+        start = default_timer()
+        for line in reindent_lines(lines, tab_size):
+            pass
+        timers['reindent'] += default_timer() - start
+
+        for row, (kind, expected) in sorted(expectations.items()):
+            counts = agreement[kind]
+            counts[0] += 1
+            if indents[row] == expected:
+                counts[1] += 1
+            elif len(mismatches) < MAX_MISMATCHES:
+                mismatches.append([path, row + 1, kind, expected,
+                                   indents[row]])
+    return {'files': files, 'skipped': skipped, 'lines': line_count,
+            'lines_per_second': dict(
+                (name, round(line_count / max(seconds, 1e-9)))
+                for name, seconds in timers.items()),
+            'agreement': agreement,
+            'mismatches': mismatches}
+
+
+def format_corpus_results(results):
+    """Return the results of corpus_benchmark as text tables."""
+    lines = ['%d files, %d lines (%d files skipped)'
+             % (results['files'], results['lines'], results['skipped']),
+             '',
+             '%-10s %12s' % ('pass', 'lines/s')]
+    for name in ('new_line', 'check', 'reindent'):
+        lines.append('%-10s %12d' % (name, results['lines_per_second'][name]))
+    lines.extend(['', '%-10s %10s %10s' % ('kind', 'lines', 'agreement')])
+    total = [0, 0]
+    for kind in CORPUS_KINDS:
+        count, agreeing = results['agreement'][kind]
+        total[0] += count
+        total[1] += agreeing
+        lines.append('%-10s %10d %9.2f%%'
+                     % (kind, count, 100.0 * agreeing / max(count, 1)))
+    lines.append('%-10s %10d %9.2f%%'
+                 % ('total', total[0], 100.0 * total[1] / max(total[0], 1)))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Latency benchmarks of python_indent.')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='number of timed calls per scenario')
+    parser.add_argument('--output', default='bench_results.json',
+                        help='results file (default bench_results.json)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='results file of a previous run')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='replay a trace file recorded with the '
+                        'trace_file setting, instead of the scenarios')
+    parser.add_argument('--corpus', metavar='DIR', nargs='?',
+                        const=os.path.dirname(os.__file__),
+                        help='run the rules over the python files of DIR '
+                        '(default: the standard library), instead of the '
+                        'scenarios, and compare them to the tokenize module')
+    args = parser.parse_args(argv)
+
+    if args.corpus:
+        results = corpus_benchmark([args.corpus])
+        print(format_corpus_results(results))
+        if results['mismatches']:
+            print('\nfirst mismatches (path, row, kind, expected, found):')
+            for mismatch in results['mismatches']:
+                print('%s:%d %s %d %d' % tuple(mismatch))
+        return 0
+
+    if args.trace:
+        with open(args.trace) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        latencies, live, diverged = replay_trace(events)
+        print(format_trace_results(latencies, live))
+        if diverged:
+            print('\n%d calls diverged from the recorded buffers' % diverged)
+        return 0
+
+    results = run_benchmarks(args.repeat, args.scenarios)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['scenarios']
+    print(format_results(results, previous))
+
+    bytes_per_line = round(line_state_bytes_per_line(mixed_code()), 1)
+    print('\nline states: %.1f bytes per line (budget %d)'
+          % (bytes_per_line, LINE_STATE_BYTES_BUDGET))
+
+    with open(args.output, 'w') as f:
+        json.dump({'revision': git_revision(),
+                   'python': platform.python_version(),
+                   'repeat': args.repeat,
+                   'line_state_bytes_per_line': bytes_per_line,
+                   'scenarios': results}, f, indent=2, sort_keys=True)
+    return 0 if bytes_per_line <= LINE_STATE_BYTES_BUDGET else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
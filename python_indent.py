@@ -8,11 +8,43 @@
 
 Sublime text plugin for automatic PEP8-style indent.
 
+The indentation rules can also be applied outside of sublime text:
+
+    $ python -m python_indent < input.py > output.py
+    $ python -m python_indent --check < input.py
+    $ python -m python_indent --check --cache .indent_cache project/
+
+and as a language server answering textDocument/onTypeFormatting:
+
+    $ python -m python_indent --server
+
 """
 
+from __future__ import print_function
+
+import base64
+import itertools
+import json
+import os
 import re
+import sys
+import threading
+import time
 import traceback
-from itertools import izip
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from keyword import kwlist
+from timeit import default_timer
+
+try:
+    xrange
+except NameError:
+    # python 3 (sublime text 3 and later)
+    xrange = range
+    basestring = str
+    long = int
 
 try:
     import sublime
@@ -28,49 +60,687 @@ except ImportError:
     sublime = FakeSublime()
     sublime_plugin = type('sublime_plugin', (), {'EventListener': object})
     sublime_plugin.TextCommand = object
-    MAX_LINE_LOOKUP_COUNT = 1000
+    sublime_plugin.WindowCommand = object
+    sublime_text = False
 
 else:
-    # maximum number of previous lines to lookup
+    sublime_text = True
+
+# sublime text 3 and later: the events are also sent off the main thread
+# (on_modified_async...), and the views are only modified by text commands
+ASYNC_EVENTS = hasattr(sublime, 'set_timeout_async')
+
+
+## instrumentation
+
+class Stats(object):
+    """Counters and histograms of the plugin hot path.
+
+    Nothing is recorded unless enabled is set (instrumentation setting).
+
+    """
+    # upper bounds of the histogram buckets
+    latency_bounds = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+    count_bounds = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        # name -> (bucket bounds, counts)
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        """Increment the counter name."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, value, bounds=count_bounds):
+        """Add value to the histogram name."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = (bounds, [0] * (len(bounds) + 1))
+            self.histograms[name] = histogram
+        histogram[1][bisect_left(bounds, value)] += 1
+
+    def timed(self, name):
+        """Decorator recording the latency (in ms) of the calls."""
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = default_timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, (default_timer() - start) * 1000,
+                                self.latency_bounds)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+    def to_dict(self):
+        """Return the statistics as a JSON serializable dict."""
+        return {
+            'counters': dict(self.counters),
+            'histograms': dict(
+                (name, {'bounds': list(bounds), 'counts': list(counts)})
+                for name, (bounds, counts) in self.histograms.items()),
+        }
+
+    def format(self, width=40):
+        """Return the statistics as text, histograms drawn with bars."""
+        lines = []
+        for name in sorted(self.counters):
+            lines.append('%s: %d' % (name, self.counters[name]))
+        for name in sorted(self.histograms):
+            bounds, counts = self.histograms[name]
+            lines.append('')
+            lines.append('%s: %d' % (name, sum(counts)))
+            top = max(counts) or 1
+            labels = ['<= %s' % b for b in bounds] + ['> %s' % bounds[-1]]
+            for label, n in zip(labels, counts):
+                lines.append('  %-8s %-*s %d'
+                             % (label, width, '#' * (n * width // top), n))
+        return '\n'.join(lines) + '\n'
+
+
+stats = Stats()
+
+
+## editing traces
+
+def _common_prefix_length(a, b):
+    """Return the length of the common prefix of the strings a and b."""
+    n = min(len(a), len(b))
+    step = 4096
+    i = 0
+    # compare whole chunks first, then bisect the first different one
+    while i + step <= n and a[i:i + step] == b[i:i + step]:
+        i += step
+    lo, hi = i, min(i + step, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[i:mid] == b[i:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix_length(a, b, limit):
+    """Return the length of the common suffix of a and b, at most limit."""
+    n = min(len(a), len(b), limit)
+    step = 4096
+    i = 0
+    while i + step <= n and (a[len(a) - i - step:len(a) - i]
+                             == b[len(b) - i - step:len(b) - i]):
+        i += step
+    lo, hi = i, min(i + step, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - i] == b[len(b) - mid:len(b) - i]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def text_delta(old, new):
+    """Return (begin, end, text): new is old with old[begin:end] replaced
+    by text."""
+    begin = _common_prefix_length(old, new)
+    suffix = _common_suffix_length(old, new, min(len(old), len(new)) - begin)
+    return begin, len(old) - suffix, new[begin:len(new) - suffix]
+
+
+def text_hash(text):
+    """Return the hash of a buffer snapshot stored in the traces."""
+    return zlib.crc32(text.encode('utf-8')) & 0xffffffff
+
+
+class TraceRecorder(object):
+    """Record the inputs of the new line and deindent commands.
+
+    Disabled unless a file is opened (trace_file setting). Each call is
+    appended to the file as a JSON line, to be replayed offline by
+    bench_python_indent.py --trace:
+
+        {"op": "start", "version": 1, "time": ...}
+        {"op": "view", "view": id, "tab_size": 4, "text": ...}
+        {"op": "new_line" or "modified", "view": id,
+         "delta": [begin, end, text], "sel": [[a, b], ...], "input": ...,
+         "hash": ..., "after": ..., "ms": ...}
+
+    The whole buffer (zlib compressed, base64 encoded) is only recorded the
+    first time a view is seen; then each call records the modification of
+    the buffer since the previous call (delta), the selections and the
+    arguments (input) of the call, the hashes of the buffer before and after
+    the call, and its latency.
+
+    """
+    version = 1
+
+    def __init__(self):
+        self.filename = None
+        self.file = None
+        # view id -> buffer after the last recorded call
+        self.texts = {}
+        # calls made by a recorded call are not recorded
+        self.depth = 0
+
+    def open(self, filename):
+        """Append the following calls to filename (None: stop recording)."""
+        if filename == self.filename:
+            return
+        self.close()
+        if filename:
+            self.file = open(filename, 'a')
+            self.filename = filename
+            self.write({'op': 'start', 'version': self.version,
+                        'time': time.time()})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.filename = None
+        self.texts = {}
+
+    def forget(self, view_id):
+        self.texts.pop(view_id, None)
+
+    def write(self, event):
+        self.file.write(json.dumps(event, separators=(',', ':')) + '\n')
+        self.file.flush()
+
+    def traced(self, op):
+        """Decorator recording the calls of NewPythonLine.run (op new_line)
+        or PythonDeindenter.on_modified (op modified)."""
+        def decorator(func):
+            def wrapper(obj, *args, **kwargs):
+                if self.file is None or self.depth:
+                    return func(obj, *args, **kwargs)
+                if op == 'new_line':
+                    view = obj.view
+                    inputs = kwargs
+                else:
+                    view = args[0]
+                    if not is_python_view(view):
+                        return func(obj, *args, **kwargs)
+                    inputs = view.command_history(0, False)
+                event = self.before(view, op, inputs)
+                self.depth += 1
+                start = default_timer()
+                try:
+                    return func(obj, *args, **kwargs)
+                finally:
+                    event['ms'] = round((default_timer() - start) * 1000, 3)
+                    self.depth -= 1
+                    self.after(view, event)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+    def before(self, view, op, inputs):
+        """Return the event of a call, recording the view if it is new."""
+        text = view.substr(sublime.Region(0, view.size()))
+        previous = self.texts.get(view.id())
+        if previous is None:
+            self.write({'op': 'view', 'view': view.id(),
+                        'tab_size': view.settings().get('tab_size'),
+                        'text': base64.b64encode(
+                            zlib.compress(text.encode('utf-8'))).decode()})
+            delta = (0, 0, '')
+        else:
+            delta = text_delta(previous, text)
+        return {'op': op, 'view': view.id(), 'delta': delta,
+                'sel': [(region.a, region.b) for region in view.sel()],
+                'input': inputs, 'hash': text_hash(text)}
+
+    def after(self, view, event):
+        text = view.substr(sublime.Region(0, view.size()))
+        self.texts[view.id()] = text
+        event['after'] = text_hash(text)
+        self.write(event)
+
+
+trace_recorder = TraceRecorder()
+
+
+## line scan cache
+
+class LineScanCache(object):
+    """Bounded memoization of scan_line.
+
+    Real code repeats a lot of lines ('pass', 'return None', ')', ...), which
+    are scanned again each time the line states are invalidated. The results
+    are kept by (line, tab_size, string) for at most size lines, recently
+    used first: entries are added to a current generation, which becomes the
+    previous one when it is full; an entry found in the previous generation
+    is moved back to the current one. (OrderedDict is not available in the
+    python 2.6 of sublime text 2.)
+
+    hits and misses count the calls found in the cache or not.
+
+    """
+    # longer lines are rarely repeated, and not stored
+    max_line_length = 256
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self.current = {}
+        self.previous = {}
+
+    def resize(self, size):
+        if size != self.size:
+            self.size = size
+            self.clear()
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def scan(self, line, tab_size=4, string=None):
+        """Return scan_line(line, tab_size, string)."""
+        key = (line, tab_size, string)
+        scan = self.current.get(key)
+        if scan is not None:
+            self.hits += 1
+            return scan
+        scan = self.previous.pop(key, None)
+        if scan is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            scan = scan_line(line, tab_size, string)
+            if len(line) > self.max_line_length:
+                return scan
+        if 2 * len(self.current) >= self.size:
+            if not self.size:
+                return scan
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = scan
+        return scan
+
+    def to_dict(self):
+        return {'size': self.size, 'lines': len(self),
+                'hits': self.hits, 'misses': self.misses}
+
+
+line_scans = LineScanCache(4096)
+
+
+## buffer caches
+
+class NoLock(object):
+    """Lock doing nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+# held while the caches are read or modified: with sublime text 3 and later,
+# they are maintained off the main thread. Sublime text 2 runs everything on
+# the main thread, and the RLock of its python 2 is slow (written in python)
+cache_lock = threading.RLock() if sys.version_info[0] >= 3 else NoLock()
+# held while the misindented lines are checked (see IndentChecker), which
+# does not read the line state caches: the lookups do not wait for the
+# checks. Taken before cache_lock, never after.
+checker_lock = threading.RLock() if sys.version_info[0] >= 3 else NoLock()
+
+
+def locked_with(lock):
+    """Return a decorator holding lock during the calls of a function."""
+    def decorator(func):
+        if isinstance(lock, NoLock):
+            return func
+
+        def wrapper(*args, **kwargs):
+            with lock:
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+# decorators holding cache_lock, or checker_lock, during the calls
+locked = locked_with(cache_lock)
+checker_locked = locked_with(checker_lock)
+
+
+def run_later(callback, delay):
+    """Call callback after delay milliseconds, off the main thread if
+    possible."""
+    if ASYNC_EVENTS:
+        sublime.set_timeout_async(callback, delay)
+    else:
+        sublime.set_timeout(callback, delay)
+
+
+class BufferCaches(object):
+    """Global memory budget of the caches of the buffers.
+
+    The caches of the buffers are kept in dicts buffer id -> cache,
+    registered here; each cache has a memory() method estimating its size
+    in bytes. Cloned views of a buffer share its caches.
+
+    The size of the caches of a buffer is estimated again each time the
+    buffer is used, and when the next buffer is used. When the caches of all
+    the buffers use more than budget bytes, the caches of the least recently
+    used buffers, other than the one in use, are dropped; they are built
+    again on their next use.
+
+    """
+    def __init__(self, budget=None):
+        # bytes (None: no limit)
+        self.budget = budget
+        self.caches = []
+        self.clock = itertools.count()
+        # buffer id -> last use (clock tick), estimated size of the caches
+        # and ids of the views using it
+        self.last_used = {}
+        self.sizes = {}
+        self.views = {}
+        # estimated size of the caches of all the buffers
+        self.total = 0
+        # buffer id of the last use
+        self.current = None
+
+    def register(self, caches):
+        """Add a dict buffer id -> cache to the budget."""
+        self.caches.append(caches)
+
+    def size(self, buffer_id):
+        """Return the estimated size of the caches of a buffer."""
+        size = 0
+        for caches in self.caches:
+            cache = caches.get(buffer_id)
+            if cache is not None:
+                size += cache.memory()
+        return size
+
+    def update(self, buffer_id):
+        """Estimate again the size of the caches of a buffer."""
+        size = self.size(buffer_id)
+        self.total += size - self.sizes.get(buffer_id, 0)
+        self.sizes[buffer_id] = size
+
+    def memory(self):
+        """Return the estimated size of the caches of all the buffers."""
+        return self.total
+
+    def exceeded(self):
+        return self.budget is not None and self.total > self.budget
+
+    def use(self, view):
+        """Record a use of the buffer of the view, and drop the caches of
+        other buffers if over budget.
+
+        Return the buffer id.
+        """
+        buffer_id = view.buffer_id()
+        self.last_used[buffer_id] = next(self.clock)
+        views = self.views.get(buffer_id)
+        if views is None:
+            views = self.views[buffer_id] = set()
+        views.add(view.id())
+        previous, self.current = self.current, buffer_id
+        if self.budget is not None:
+            if previous != buffer_id and previous in self.sizes:
+                # the caches of the previous buffer may have grown since
+                # its use
+                self.update(previous)
+            self.update(buffer_id)
+            if self.total > self.budget:
+                self.evict(buffer_id)
+        return buffer_id
+
+    def evict(self, keep):
+        """Drop the caches of the least recently used buffers other than
+        keep, until the budget is met."""
+        last_used = self.last_used
+        candidates = sorted((last_used[buffer_id], buffer_id)
+                            for buffer_id, size in self.sizes.items()
+                            if size and buffer_id != keep)
+        for tick, buffer_id in candidates:
+            if not self.exceeded():
+                break
+            self.drop(buffer_id)
+            if stats.enabled:
+                stats.count('evicted buffer caches')
+
+    def drop(self, buffer_id):
+        """Drop the caches of the buffer."""
+        for caches in self.caches:
+            caches.pop(buffer_id, None)
+        self.total -= self.sizes.pop(buffer_id, 0)
+
+    def close(self, view):
+        """Forget the view, and the caches of its buffer if it was the last
+        view using them."""
+        buffer_id = view.buffer_id()
+        views = self.views.get(buffer_id)
+        if views is not None:
+            views.discard(view.id())
+            if views:
+                return
+        self.drop(buffer_id)
+        self.last_used.pop(buffer_id, None)
+        self.views.pop(buffer_id, None)
+
+
+buffer_caches = BufferCaches()
+
+
+## settings
+
+# time budget of the scan of a lookup, in seconds (None: no limit)
+LOOKUP_TIME_BUDGET = 0.05
+# mark the misindented lines in the gutter
+misindentation_markers = False
+# scan the python views in the background, see IndexScheduler
+background_indexing = True
+
+
+def load_settings():
+    """Apply python_indent.sublime-settings.
+
+    Called again each time the settings file changes.
+    """
+    global LOOKUP_TIME_BUDGET, misindentation_markers, background_indexing
+    budget = settings.get("lookup_time_budget_ms", 50)
+    LOOKUP_TIME_BUDGET = budget / 1000.0 if budget > 0 else None
+    # record latencies and counters, see the show_python_indent_stats command
+    stats.enabled = settings.get("instrumentation", False)
+    line_scans.resize(settings.get("line_scan_cache_size", 4096))
+    budget = settings.get("cache_memory_budget_mb", 256)
+    buffer_caches.budget = budget * (1 << 20) if budget > 0 else None
+    misindentation_markers = settings.get("misindentation_markers", False)
+    background_indexing = settings.get("background_indexing", True)
+    # record the editing sessions, see TraceRecorder
+    trace_file = settings.get("trace_file", "")
+    trace_recorder.open(os.path.expanduser(trace_file) if trace_file
+                        else None)
+
+
+settings = None
+
+
+def plugin_loaded():
+    """Load python_indent.sublime-settings.
+
+    Called by sublime text 3 and later once its API is ready.
+    """
+    global settings
     settings = sublime.load_settings('python_indent.sublime-settings')
-    MAX_LINE_LOOKUP_COUNT = settings.get("max_line_lookup_count", 1000)
+    load_settings()
+    settings.add_on_change('python_indent', load_settings)
+
+
+if sublime_text and not ASYNC_EVENTS:
+    plugin_loaded()
 
 
 ## new line indent
 
-reverse_enumerate = lambda l: izip(reversed(xrange(len(l))), reversed(l))
+# characters the lexer stops on outside of literal strings
+special_char_regex = re.compile(r'''[()\[\]{}"'#]''')
+# rest of a literal string, from its opening quote excluded
+string_end_regex = {
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"'),
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*'"),
+    '"""': re.compile(r'[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*"""'),
+    "'''": re.compile(r"[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*'''"),
+}
+first_word_regex = re.compile(r'\s*(\w*)')
+matching_brackets = {')': '(', ']': '[', '}': '{'}
+
+block_keywords = frozenset(('class', 'def', 'elif', 'else', 'except',
+                            'finally', 'for', 'if', 'try', 'with', 'while'))
+stop_keywords = frozenset(('pass', 'continue', 'break'))
+stop_statement_keywords = frozenset(('return', 'raise', 'yield'))
+
+
+def _string_quote(s, start):
+    """Return the quote of the literal string starting at start."""
+    quote = s[start]
+    if s.startswith(quote * 3, start):
+        return quote * 3
+    return quote
 
 
-newblock_start_pattern = re.compile(
-    r'^\s*(class|def|elif|else|except|finally|for|if|try|with|while)\b.*$')
-escape_pattern = r'(?<!(%s\\))'
-string_regex = re.compile(r"""(?P<quote>["'])(?P<str>.*?)(%s)(?P=quote)""" % (
-    escape_pattern % escape_pattern % escape_pattern % escape_pattern % ''))
-comment_regex = re.compile(r"([^#]*)(#(.*))?")
-stopexecution_pattern = re.compile(
-    r'^\s*(pass\b|return\b.*|continue\b|break\b|raise\b.*|yield\b.*)\s*$')
-blankline_pattern = re.compile(r'^\s*$')
+def _string_end(s, quote, start):
+    """Return the index following the literal string opened before start.
+
+    Return -1 if the string is not terminated on the line.
+    """
+    m = string_end_regex[quote].match(s, start)
+    if m is None:
+        return -1
+    return m.end()
+
+
+def _string_continued(s, quote):
+    """Return whether an unterminated string continues on the next line.
+
+    Triple-quoted strings always continue; single-quoted strings only
+    continue after a backslash.
+    """
+    if len(quote) == 3:
+        return True
+    return (len(s) - len(s.rstrip('\\'))) % 2 == 1
 
 
-def _replace_reserved_char(s):
-    """Return the given string with all its brackets and # replaced by _."""
-    for c in '()[]{}#':
-        s = s.replace(c, '_')
-    return s
+def line_kind(s, endpos=None):
+    """Return the kind of statement of the given line.
 
+    Arguments
+    ---------
+    s: line
+    endpos: index of the end of the code of the line (start of the comment,
+        default to the end of the line)
+
+    Return
+    ------
+    'block' for a new block start (class, def, if...), 'stop' for an end of
+    execution statement (pass, return...), None otherwise.
+    """
+    if endpos is None:
+        endpos = len(s)
+    m = first_word_regex.match(s, 0, endpos)
+    word = m.group(1)
+    if word in block_keywords:
+        return 'block'
+    elif word in stop_statement_keywords:
+        return 'stop'
+    elif word in stop_keywords and not s[m.end():endpos].strip():
+        return 'stop'
+    return None
 
-def _filter_quote(m):
-    return ''.join((m.group('quote'),
-                    _replace_reserved_char(m.group('str')),
-                    m.group('quote')
-                    ))
 
+def scan_line(s, tab_size=4, string=None):
+    """Scan a line in a single forward pass.
+
+    Literal strings and comments are skipped; brackets are matched
+    independently for each kind of bracket.
+
+    Arguments
+    ---------
+    s: line
+    tab_size: tabs are count as 'tab_size' spaces (default 4).
+    string: quote of a literal string opened on a previous line and still
+        open at the start of the line (default None).
+
+    Return
+    ------
+    (indent, kind, closing, opening, length, string)
+    indent: indentation of the line.
+    kind: kind of statement, as returned by line_kind. Always None for a line
+        starting inside a literal string.
+    closing: string of the closing brackets without an opening bracket on the
+        line, in order.
+    opening: tuple of (bracket, index) of the opening brackets without a
+        closing bracket on the line, in order.
+    length: length of the line without its comment.
+    string: quote of the literal string still open at the end of the line, or
+        None.
+    """
+    indent = get_line_current_indent(s, tab_size)
+    in_string = string is not None
+    pos = 0
+    if in_string:
+        pos = _string_end(s, string, 0)
+        if pos == -1:
+            # whole line inside the string
+            if not _string_continued(s, string):
+                string = None
+            return (indent, None, '', (), len(s), string)
+        string = None
+
+    openers = []
+    opened = {'(': [], '[': [], '{': []}
+    closing = ''
+    length = len(s)
+    m = special_char_regex.search(s, pos)
+    while m is not None:
+        c = m.group()
+        pos = m.end()
+        if c in '([{':
+            opened[c].append(len(openers))
+            openers.append((c, m.start()))
+        elif c in ')]}':
+            stack = opened[matching_brackets[c]]
+            if stack:
+                openers[stack.pop()] = None
+            else:
+                closing += c
+        elif c == '#':
+            length = m.start()
+            break
+        else:
+            quote = _string_quote(s, m.start())
+            pos = _string_end(s, quote, m.start() + len(quote))
+            if pos == -1:
+                if _string_continued(s, quote):
+                    string = quote
+                break
+        m = special_char_regex.search(s, pos)
 
-def line_filter(s):
-    """Remove brackets from literal string in lines. Remove comments."""
-    s = string_regex.sub(_filter_quote, s)
-    s = comment_regex.search(s).group(1)
-    return s
+    kind = None if in_string else line_kind(s, length)
+    opening = tuple(o for o in openers if o is not None)
+    return (indent, kind, closing, opening, length, string)
 
 
 def get_line_current_indent(string, tab_size=4):
@@ -94,92 +764,428 @@ def get_line_current_indent(string, tab_size=4):
     return indent
 
 
-def unmatched_bracket_lookup(s, in_counter=None):
-    """Look for an unmatched bracket ((), [] and {}) in the given string.
+## line states
+#
+# The state at the start of a line is a tuple (string, brackets).
+#
+# string: None, or (quote, stmt_row, stmt_indent) if a literal string opened
+#     on a previous line is still open.
+# brackets: tuple of the brackets still open, in opening order. Each open
+#     bracket is stored as (bracket, row, indent, stmt_row, stmt_indent).
+#     row: row of the line where the bracket was opened.
+#     indent: indentation of a new line following this bracket.
+#
+# stmt_row, stmt_indent: row of the first line of the statement the string or
+#     bracket belongs to, and indentation of a new line following that
+#     statement once the string or bracket is closed. stmt_row is -1 if an
+#     unmatched closing bracket makes the statement start undetermined.
+#
+# Brackets of different kinds are matched independently.
+
+EMPTY_LINE_STATE = (None, ())
+
+# first words of the lines stored by LineStateCache, by code; other words
+# have the code 0
+LINE_WORDS = ('',) + tuple(kwlist)
+line_word_codes = dict((word, code) for code, word in enumerate(LINE_WORDS))
+
+# size of the first chunk of text read from the view by a forward scan; each
+# following chunk is twice as large, up to MAX_SCAN_CHUNK_SIZE
+SCAN_CHUNK_SIZE = 1 << 16
+MAX_SCAN_CHUNK_SIZE = 1 << 22
+
+
+def advance_line_state(line, row, state, tab_size=4):
+    """Process a line, starting with the given state.
 
     Arguments
     ---------
-    s: string to analyze
-    in_counter: dict containing the count of brackets from a following line
+    line: line (or beginning of line).
+    row: row of the line in the view (int).
+    state: state at the start of the line.
+    tab_size: tabs are count as 'tab_size' spaces (default 4).
 
     Return
     ------
-    ('balanced', None) if there is no unbalanced bracket.
-    ('unmatch_close', counter_dict) if the string contain an unmatched closing
-        bracket. counter_dict is the dict containing the count of brackets
-    ('unmatch_open', index) if the string contains an unmatched opening bracket
-        index is the last unmatched opening bracket index (int)
-
-    If there is both opening and closing unmatched brackets, the last one takes
-    the priority.
-    """
-    matching = {')': '(', '}': '{', ']': '['}
-    counter = {'(': 0, '{': 0, '[': 0}
-    if in_counter:
-        counter.update(in_counter)
-    for i, c in reverse_enumerate(s):
-        if c in '({[':
-            if counter[c] is 0:
-                return ('unmatch_open', i)
-            else:
-                counter[c] -= 1
-        if c in ')}]':
-            counter[matching[c]] += 1
-
-    if counter.values() == [0, 0, 0]:
-        return ('balanced', None)
+    (state, indent): the state at the end of the line, and the indentation of
+        a new line inserted after it.
+    """
+    string = state[0] and state[0][0]
+    return apply_line_scan(line_scans.scan(line, tab_size, string), row,
+                           state, tab_size)
+
+
+def apply_line_scan(scan, row, state, tab_size=4):
+    """Same as advance_line_state, for a line already scanned by scan_line."""
+    indent, kind, closing, opening, length, string = scan
+    in_string, brackets = state
+    if in_string is not None:
+        # the line continues the statement of the string
+        if string is not None and not closing and not opening:
+            return state, indent
+        stmt_row, stmt_indent = in_string[1], in_string[2]
     else:
-        return ('unmatch_close', counter)
+        if kind == 'block':
+            stmt_indent = indent + tab_size
+        elif kind == 'stop':
+            stmt_indent = max(0, indent - tab_size)
+        else:
+            stmt_indent = indent
+        if not closing and not opening and string is None:
+            # balanced line: the new line follows it
+            return state, stmt_indent
+        stmt_row = row
+
+    stack = list(brackets)
+    min_row = stmt_row
+    for bracket in closing:
+        opening_bracket = matching_brackets[bracket]
+        for i in xrange(len(stack) - 1, -1, -1):
+            if stack[i][0] == opening_bracket:
+                opened = stack.pop(i)
+                if opened[1] < min_row:
+                    min_row = opened[1]
+                    stmt_row, stmt_indent = opened[3], opened[4]
+                break
+        else:
+            # unmatched closing bracket
+            min_row = -1
+            stmt_row, stmt_indent = -1, 0
+
+    if opening:
+        bracket, col = opening[-1]
+        if col != length - 1:
+            new_indent = col + 1
+        elif kind == 'block':
+            new_indent = indent + 2 * tab_size
+        else:
+            new_indent = indent + tab_size
+    elif stack and stack[-1][1] >= stmt_row:
+        new_indent = stack[-1][2]
+    else:
+        new_indent = stmt_indent
+
+    new_brackets = [b if b[1] <= min_row
+                    else (b[0], b[1], b[2], stmt_row, stmt_indent)
+                    for b in stack]
+    new_brackets.extend((bracket, row, col + 1, stmt_row, stmt_indent)
+                        for bracket, col in opening[:-1])
+    if opening:
+        new_brackets.append((bracket, row, new_indent, stmt_row, stmt_indent))
+
+    if string is not None:
+        # the new line is inside the string
+        return ((string, stmt_row, stmt_indent), tuple(new_brackets)), indent
+    return (None, tuple(new_brackets)), new_indent
+
+
+def line_backslash(line, scan):
+    """Return whether the line, scanned by scan_line, ends with a backslash
+    continuation, or None if it has no code (the previous line with code
+    decides)."""
+    length, string = scan[4], scan[5]
+    if string is None and not line[:length].strip():
+        return None
+    return (string is None and length == len(line)
+            and line[:length].rstrip().endswith('\\'))
+
+
+def iter_view_lines(view, begin, end):
+    """Yield the complete lines of the view between the points begin and end.
+
+    The text is read by chunks growing exponentially, so that a scan of n
+    lines costs O(log n) calls to the view while its memory use stays
+    bounded.
+    """
+    chunk_size = SCAN_CHUNK_SIZE
+    tail = ''
+    while begin < end:
+        chunk_end = min(end, begin + chunk_size)
+        text = tail + view.substr(sublime.Region(begin, chunk_end))
+        lines = text.split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+        begin = chunk_end
+        chunk_size = min(2 * chunk_size, MAX_SCAN_CHUNK_SIZE)
+
+
+class ScanCost(object):
+    """Measured cost of the forward scan, to check the time budget cheaply.
+
+    The clock is read every check_interval characters, about ten times per
+    budget at the measured cost per character.
+    """
+    def __init__(self):
+        # seconds per character, moving average
+        self.char_cost = 5e-7
 
+    def update(self, chars, seconds):
+        if chars >= 1024:
+            self.char_cost += (seconds / chars - self.char_cost) / 4
 
-def string_to_next_line_indent(line, brackets_counter=None):
-    """Return the indentation for a line following the given string
+    def affordable(self, budget):
+        """Return the number of characters that can be scanned in budget."""
+        return int(budget / self.char_cost)
 
-    If the given line is not enough to determine the indentation (unmatched
-        closing brackets), can be call again, with the brackets_counter
-        returned as argument.
+    def check_interval(self, budget):
+        return max(1, min(1 << 16, self.affordable(budget) // 10))
 
-    Argument
-    --------
-    line: current line (string).
-    brackets_counter: dict containing a brackets count (as returned by the
-        function).
 
-    Return
-    ------
-    ('increase_level', i) if the indentation level should be increased. i is
-        the number of level increase needed.
-    ('decrease_level', i) if the indentation level should be decreased. i is
-        the number of level decrease needed
-    ('absolute', i) to indicate an absolute level of indentation. i is the
-        number of spaces to insert before the line.
-    ('unchanged', 0) if the indentation level should not be changed
-    ('unmatched_closing_bracket', brackets_counter) if there is unmatched
-        closing brackets. The function must be called again with the previous
-        line.
-    """
-    status, param = unmatched_bracket_lookup(line, brackets_counter)
-    if status == 'balanced':
-        if newblock_start_pattern.match(line):
-            return ('increase_level', 1)
-        elif stopexecution_pattern.match(line):
-            return ('decrease_level', 1)
-        else:
-            return ('unchanged', None)
-    elif status == 'unmatch_open':
-        if param is len(line)-1:
-            if newblock_start_pattern.match(line):
-                return ('increase_level', 2)
+scan_cost = ScanCost()
+
+
+def lookup_deadline():
+    """Return the time at which a lookup starting now must end, or None."""
+    if LOOKUP_TIME_BUDGET is None:
+        return None
+    return default_timer() + LOOKUP_TIME_BUDGET
+
+
+statement_start_regex = re.compile(r'\n(?=[A-Za-z_@])')
+
+
+def statement_start(view, point):
+    """Return the start of the nearest line before point beginning with a
+    statement at column 0, or 0.
+
+    The text before point is read backward, by chunks growing exponentially.
+    """
+    chunk_size = 4096
+    end = point
+    while end > 0:
+        begin = max(0, end - chunk_size)
+        # one more character for the lookahead, but never the point line
+        text = view.substr(sublime.Region(begin, min(end + 1, point)))
+        last = None
+        for last in statement_start_regex.finditer(text):
+            pass
+        if last is not None:
+            return begin + last.end()
+        end = begin
+        chunk_size = min(2 * chunk_size, MAX_SCAN_CHUNK_SIZE)
+    return 0
+
+
+def best_effort_start(view, point):
+    """Return the point from which a lookup past its time budget reads the
+    view: the nearest statement at column 0, or the point itself if that
+    statement is too far to be scanned within the budget.
+    """
+    start = statement_start(view, point)
+    if point - start > scan_cost.affordable(LOOKUP_TIME_BUDGET or 0.05):
+        return point
+    return start
+
+
+def best_effort_line_state(view, point, tab_size):
+    """Return (row, state) of the line starting at point, scanning from
+    best_effort_start instead of the beginning of the view.
+
+    The row is relative to that start.
+    """
+    row = 0
+    state = EMPTY_LINE_STATE
+    for line in iter_view_lines(view, best_effort_start(view, point), point):
+        state = advance_line_state(line, row, state, tab_size)[0]
+        row += 1
+    return row, state
+
+
+class LineStateCache(object):
+    """Bracket states at the start of the lines of a view.
+
+    States are computed forward from the beginning of the view, and kept for
+    each line up to the last line requested. A modification of the view only
+    invalidates the states of the lines following it.
+
+    The scanned lines are also indexed by indentation, for
+    previous_keyword_lookup.
+
+    To keep large views cheap, the lines are stored in arrays, and a state
+    is only stored on the lines where it changes (see
+    bench_python_indent.LINE_STATE_BYTES_BUDGET).
+
+    """
+    def __init__(self, tab_size, size):
+        self.tab_size = tab_size
+        self.size = size
+        # points of the line starts
+        self.points = array('l', [0])
+        # rows where the state changes, and the states from these rows
+        self.state_rows = array('i', [0])
+        self.state_values = [EMPTY_LINE_STATE]
+        # indentation and code of the first word (see LINE_WORDS) of the
+        # scanned lines; the indentation is -1 for the lines which do not
+        # start a statement (blank, comment and continuation lines), as in
+        # KeywordStack
+        self.indents = array('i')
+        self.word_codes = array('B')
+        # indent -> sorted rows of the scanned lines with this indentation
+        self.indent_rows = {}
+
+    def invalidate(self, point, size):
+        """Drop the states of the lines starting after the given point."""
+        del_from = max(1, bisect_right(self.points, point))
+        del self.points[del_from:]
+        run = bisect_left(self.state_rows, del_from)
+        del self.state_rows[run:]
+        del self.state_values[run:]
+        # the line containing the point is modified
+        if del_from - 1 < len(self.indents):
+            del self.indents[del_from - 1:]
+            del self.word_codes[del_from - 1:]
+            for rows in self.indent_rows.values():
+                if rows and rows[-1] >= del_from - 1:
+                    del rows[bisect_left(rows, del_from - 1):]
+        self.size = size
+
+    # estimated size of a state, in bytes
+    state_bytes = 200
+
+    def memory(self):
+        """Return the estimated size of the cache, in bytes."""
+        # at most one row in indent_rows per scanned line
+        return (len(self.points) * self.points.itemsize
+                + len(self.indents) * (2 * self.indents.itemsize + 1)
+                + len(self.state_rows) * self.state_rows.itemsize
+                + len(self.state_values) * self.state_bytes)
+
+    def state(self, row):
+        """Return the state at the start of a scanned row."""
+        return self.state_values[bisect_right(self.state_rows, row) - 1]
+
+    def line_state(self, view, point, deadline=None):
+        """Return (row, state) of the line starting at the given point.
+
+        If the scan of the missing lines lasts past deadline, it stops and
+        None is returned; the lines scanned so far are kept.
+        """
+        points = self.points
+        row = bisect_right(points, point) - 1
+        if points[row] == point:
+            if stats.enabled:
+                stats.count('line state cache hits')
+            return row, self.state(row)
+        if stats.enabled:
+            stats.count('line state cache misses')
+        if row < len(points) - 1:
+            # not a line start: the cache missed a modification
+            self.invalidate(0, self.size)
+
+        first_row = len(points) - 1
+        complete = self.scan(view, point, deadline)
+        row = len(points) - 1
+        if stats.enabled:
+            stats.record('line state lines scanned', row - first_row)
+            if not complete:
+                stats.count('lookup time budget exceeded')
+        if not complete:
+            return None
+        return row, self.state_values[-1]
+
+    def scan(self, view, point, deadline=None):
+        """Scan the lines following the last scanned line, up to the line
+        starting at point.
+
+        Return False if the scan lasted past deadline and stopped before
+        point, True otherwise.
+        """
+        points = self.points
+        row = len(points) - 1
+        state = self.state_values[-1]
+        start = points[-1]
+        tab_size = self.tab_size
+        indents = self.indents
+        word_codes = self.word_codes
+        indent_rows = self.indent_rows
+        if deadline is not None:
+            interval = countdown = scan_cost.check_interval(
+                max(0, deadline - default_timer()))
+        first_point = start
+        exceeded = False
+        start_time = default_timer()
+        backslash = self.backslash(view, row)
+        for line in iter_view_lines(view, start, point):
+            scan = line_scans.scan(line, tab_size, state[0] and state[0][0])
+            new_state = apply_line_scan(scan, row, state, tab_size)[0]
+            continued = backslash or state[0] is not None or state[1]
+            ends_backslash = line_backslash(line, scan)
+            if ends_backslash is not None:
+                backslash = ends_backslash
+            stripped = line.lstrip()
+            if stripped and stripped[0] != '#' and not continued:
+                indent = get_line_current_indent(line, tab_size)
+                word = first_word_regex.match(line).group(1)
+                indents.append(indent)
+                word_codes.append(line_word_codes.get(word, 0))
+                rows = indent_rows.get(indent)
+                if rows is None:
+                    rows = indent_rows[indent] = array('i')
+                rows.append(row)
             else:
-                return ('increase_level', 1)
-        else:
-            return ('absolute', param+1)
-    elif status == 'unmatch_close':
-        return 'unmatched_closing_bracket', param
-    else:
-        print "unexcepted return value from unmatched_bracket_lookup"
+                indents.append(-1)
+                word_codes.append(0)
+            start += len(line) + 1
+            row += 1
+            points.append(start)
+            if new_state is not state:
+                self.state_rows.append(row)
+                self.state_values.append(new_state)
+                state = new_state
+            if deadline is not None:
+                countdown -= len(line) + 1
+                if countdown <= 0:
+                    if default_timer() > deadline:
+                        exceeded = True
+                        break
+                    countdown = interval
+        scan_cost.update(start - first_point, default_timer() - start_time)
+        return not exceeded
+
+    def backslash(self, view, row):
+        """Return whether the scanned line preceding row continues with a
+        backslash (see line_backslash)."""
+        points = self.points
+        while row > 0:
+            row -= 1
+            line = view.substr(sublime.Region(points[row],
+                                              points[row + 1] - 1))
+            string = self.state(row)[0]
+            backslash = line_backslash(line, line_scans.scan(
+                line, self.tab_size, string and string[0]))
+            if backslash is not None:
+                return backslash
+        return False
+
+
+# buffer id -> LineStateCache
+line_state_caches = {}
+buffer_caches.register(line_state_caches)
+
+
+def get_line_state_cache(view):
+    """Return the LineStateCache of the buffer of the view, creating it if
+    needed."""
+    tab_size = view.settings().get('tab_size')
+    size = view.size()
+    buffer_id = buffer_caches.use(view)
+    cache = line_state_caches.get(buffer_id)
+    if cache is None or cache.tab_size != tab_size or cache.size != size:
+        cache = LineStateCache(tab_size, size)
+        line_state_caches[buffer_id] = cache
+    return cache
+
 
+@locked
+def invalidate_line_states(view, point):
+    """Invalidate the cached states of the lines following the point."""
+    cache = line_state_caches.get(view.buffer_id())
+    if cache is not None:
+        cache.invalidate(point, view.size())
 
+
+@locked
 def get_new_line_indent(view, cursor):
     """Return the proper indentation of a new line inserted at the cursor.
 
@@ -196,38 +1202,29 @@ def get_new_line_indent(view, cursor):
     tab_size = view.settings().get('tab_size')
 
     start_line = view.line(cursor).begin()
-    line = line_filter(view.substr(sublime.Region(start_line, cursor)))
+    row_state = get_line_state_cache(view).line_state(view, start_line,
+                                                      lookup_deadline())
+    if row_state is None:
+        row_state = best_effort_line_state(view, start_line, tab_size)
+    row, state = row_state
+    line = view.substr(sublime.Region(start_line, cursor))
 
-    new_indent, indent_param = string_to_next_line_indent(line)
+    return advance_line_state(line, row, state, tab_size)[1]
 
-    line_lookup_count = MAX_LINE_LOOKUP_COUNT
-    while new_indent == 'unmatched_closing_bracket' and line_lookup_count:
-        line_lookup_count -= 1
-        if start_line is 0 or not line_lookup_count:
-            new_indent = 'error'
-            indent_param = None
-            break
-        line = view.line(start_line-1)
-        start_line = line.begin()
-        line = line_filter(view.substr(line))
-        if blankline_pattern.match(line):
-            continue
-        new_indent, indent_param = string_to_next_line_indent(
-            line, indent_param)
-
-    current_indent = get_line_current_indent(
-        line, view.settings().get('tab_size'))
-
-    if new_indent == 'absolute':
-        return indent_param
-    elif new_indent == 'unchanged':
-        return current_indent
-    elif new_indent == 'increase_level':
-        return current_indent + tab_size * indent_param
-    elif new_indent == 'decrease_level':
-        return max(0, current_indent - tab_size * indent_param)
-    else:
-        return 0
+
+def replace_lines(view, edit, edits):
+    """Apply the edits [(begin, end, text), ...], sorted from the last one,
+    and invalidate the line states following them.
+
+    The edits are applied from the last one, so that the points of the
+    previous ones stay valid.
+    """
+    for begin, end, text in edits:
+        if begin == end:
+            view.insert(edit, begin, text)
+        else:
+            view.replace(edit, sublime.Region(begin, end), text)
+    invalidate_line_states(view, edits[-1][0])
 
 
 class NewPythonLine(sublime_plugin.TextCommand):
@@ -237,49 +1234,27 @@ class NewPythonLine(sublime_plugin.TextCommand):
     new line.
 
     """
+    @trace_recorder.traced('new_line')
+    @stats.timed('NewPythonLine.run ms')
+    @locked
     def run(self, edit, register='', full_line=False, forward=True):
+        new_line_char = self.new_line_char()
         try:
-            new_sel = []
-            for region in self.view.sel():
-                # set the insert point
-                if full_line:
-                    if forward:
-                        cursor = self.view.line(region).end()
-                    else:
-                        cursor = self.view.line(region).begin() - 1
-                else:
-                    cursor = region.begin()
+            regions = sorted(self.view.sel(), key=lambda r: r.begin())
+            edits = self.new_line_edits(regions, new_line_char, full_line,
+                                        forward)
 
-                indent = get_new_line_indent(self.view, cursor)
+            if edits:
+                replace_lines(self.view, edit, [
+                    (begin, end, text)
+                    for begin, end, text, offset in reversed(edits)])
 
-                if self.view.line_endings() == 'Windows':
-                    new_line_char = '\r\n'
-                elif self.view.line_endings() == 'CR':
-                    new_line_char = '\r'
-                else:
-                    new_line_char = '\n'  # Linux is default
-
-                row, col = self.view.rowcol(cursor)
-
-                if not full_line:
-                    to_replace = sublime.Region(
-                        cursor, self.view.line(region).end())
-                    if region.empty():
-                        new_line_content = \
-                            self.view.substr(to_replace).lstrip()
-                    else:
-                        new_line_content = self.view.substr(sublime.Region(
-                            region.end(), to_replace.end())).lstrip()
-
-                    self.view.replace(
-                        edit, to_replace,
-                        new_line_char + ' '*indent + new_line_content)
-                    cursor += indent + 1
-                    new_sel.append(sublime.Region(cursor, cursor))
-                else:
-                    self.view.insert(edit, cursor, new_line_char + ' '*indent)
-                    cursor += indent + 1
-                    new_sel.append(sublime.Region(cursor, cursor))
+            new_sel = []
+            shift = 0
+            for begin, end, text, offset in edits:
+                cursor = begin + shift + offset
+                new_sel.append(sublime.Region(cursor, cursor))
+                shift += len(text) - (end - begin)
 
             if new_sel:
                 self.view.sel().clear()
@@ -287,29 +1262,104 @@ class NewPythonLine(sublime_plugin.TextCommand):
                     self.view.sel().add(region)
         except:
             # fail safe
-            print traceback.format_exc()
-            if self.view.line_endings() == 'Windows':
-                new_line_char = '\r\n'
-            elif self.view.line_endings() == 'CR':
-                new_line_char = '\r'
-            else:
-                new_line_char = '\n'  # Linux is default
+            print(traceback.format_exc())
             for sel in self.view.sel():
                 self.view.insert(edit, sel.end(), new_line_char)
 
+    def new_line_char(self):
+        line_endings = self.view.line_endings()
+        if line_endings == 'Windows':
+            return '\r\n'
+        elif line_endings == 'CR':
+            return '\r'
+        return '\n'  # Linux is default
+
+    def new_line_edits(self, regions, new_line_char, full_line, forward):
+        """Return the edits adding a new line for each of the regions.
+
+        The indentation of all the new lines is computed on the text before
+        any modification; as the regions are sorted, the line states scanned
+        for a cursor are reused for the following ones.
+
+        Arguments
+        ---------
+        regions: selected regions, sorted by their beginning.
+
+        Return
+        ------
+        list of (begin, end, text, offset), sorted, to replace the text
+        between the points begin and end with text. offset is the position
+        of the new cursor in text.
+        """
+        view = self.view
+        edits = []
+        for i, region in enumerate(regions):
+            # set the insert point
+            if full_line:
+                if forward:
+                    cursor = view.line(region).end()
+                else:
+                    cursor = view.line(region).begin() - 1
+            else:
+                cursor = region.begin()
+
+            indent = get_new_line_indent(view, cursor)
+            offset = len(new_line_char) + indent
+
+            if full_line:
+                edits.append((cursor, cursor, new_line_char + ' '*indent,
+                              offset))
+                continue
+
+            end = view.line(region).end()
+            if i + 1 < len(regions):
+                # do not move the text of the next cursor on the line
+                end = max(region.end(), min(end, regions[i + 1].begin()))
+            new_line_content = view.substr(
+                sublime.Region(region.end(), end)).lstrip()
+            edits.append((cursor, end,
+                          new_line_char + ' '*indent + new_line_content,
+                          offset))
+        return edits
+
 
 ## deindent on keywords
 
 
-def previous_keyword_lookup(view, cursor, keywords, ignore):
+keyword_sets = {}
+
+
+def get_keyword_set(keywords):
+    """Return the keywords as a frozenset, memoized."""
+    key = tuple(keywords)
+    words = keyword_sets.get(key)
+    if words is None:
+        words = keyword_sets[key] = frozenset(keywords)
+    return words
+
+
+@locked
+def previous_keyword_lookup(view, cursor, keywords, ignore, max_indent=None):
     """Search for a previous keyword.
 
+    Going up from the cursor, a line starting with a keyword is found if its
+    indentation is lower than the one of the cursor line and of the lines in
+    between, lines starting with an ignored keyword, blank and comment lines
+    excepted.
+
+    Instead of reading the previous lines one by one, the indentation index
+    of the LineStateCache of the view is used to jump to the previous line
+    that may end the lookup. If the lines above the cursor cannot be indexed
+    within LOOKUP_TIME_BUDGET, the lines up to the nearest statement at
+    column 0 are read instead.
+
     Arguments
     ---------
     view: sublime.View
     cursor: current sublime text cursor (int)
     keywords: list of keywords to search
     ignore: list of keywords to ignore
+    max_indent: indentation of the cursor line (default: the current one)
 
     Return
     ------
@@ -319,36 +1369,73 @@ def previous_keyword_lookup(view, cursor, keywords, ignore):
 
     if isinstance(keywords, basestring):
         keywords = [keywords]
+    keywords = get_keyword_set(keywords)
+    ignore = get_keyword_set(ignore)
 
     tab_size = view.settings().get('tab_size')
-    line_lookup_count = MAX_LINE_LOOKUP_COUNT
-
-    kw_regex = re.compile(r'^\s*(%s)\b' % '|'.join(keywords))
-    ignore_regex = re.compile(r'^\s*(%s)\b' % '|'.join(ignore))
 
     line = view.line(cursor)
-    start_line = line.begin()
-    max_indent = get_line_current_indent(view.substr(line), tab_size)
-
-    while line_lookup_count:
-        if start_line is 0:
-            return -1
-        line_lookup_count -= 1
-
-        line = view.line(start_line-1)
-        start_line = line.begin()
-        str_line = view.substr(line)
-        indent = get_line_current_indent(str_line, tab_size)
-        if kw_regex.match(str_line):
-            if indent <= max_indent:
-                return indent
-        elif not ignore_regex.match(str_line):
-            max_indent = min(indent - tab_size, max_indent)
-            if max_indent < 0:
+    if max_indent is None:
+        max_indent = get_line_current_indent(view.substr(line), tab_size)
+    cache = get_line_state_cache(view)
+    row_state = cache.line_state(view, line.begin(), lookup_deadline())
+    if row_state is None:
+        return best_effort_keyword_lookup(view, line.begin(), max_indent,
+                                          keywords, ignore, tab_size)
+    row = row_state[0]
+    indents = cache.indents
+    word_codes = cache.word_codes
+    indent_rows = cache.indent_rows.items()
+
+    steps = 0
+    try:
+        while True:
+            # previous line with an indentation that may end the lookup
+            found = -1
+            bound = max_indent + tab_size
+            for indent, rows in indent_rows:
+                if indent < bound:
+                    i = bisect_left(rows, row) - 1
+                    if i >= 0 and rows[i] > found:
+                        found = rows[i]
+            if found == -1:
                 return -1
-    else:
-        print "max line lookup reach"
-        return -1
+
+            steps += 1
+            row = found
+            indent = indents[row]
+            word = LINE_WORDS[word_codes[row]]
+            if word in keywords:
+                if indent <= max_indent:
+                    return indent
+            elif word not in ignore:
+                max_indent = min(indent - tab_size, max_indent)
+                if max_indent < 0:
+                    return -1
+    finally:
+        if stats.enabled:
+            stats.record('previous_keyword_lookup steps', steps)
+
+
+def best_effort_keyword_lookup(view, point, max_indent, keywords, ignore,
+                               tab_size):
+    """previous_keyword_lookup reading the lines before the point up to the
+    nearest statement at column 0 (see best_effort_start), through a
+    KeywordStack.
+    """
+    stack = KeywordStack(tab_size)
+    state = EMPTY_LINE_STATE
+    backslash = False
+    for row, line in enumerate(
+            iter_view_lines(view, best_effort_start(view, point), point)):
+        scan = line_scans.scan(line, tab_size, state[0] and state[0][0])
+        if not backslash and state[0] is None and not state[1]:
+            stack.add(line)
+        state = apply_line_scan(scan, row, state, tab_size)[0]
+        ends_backslash = line_backslash(line, scan)
+        if ends_backslash is not None:
+            backslash = ends_backslash
+    return stack.lookup(keywords, ignore, max_indent)
 
 
 indent_regex = re.compile(r'^\s*')
@@ -362,6 +1449,34 @@ finally_pattern = re.compile(r'^\s*finally\s*:')
 except_pattern = re.compile(r'^\s*except\b')
 elif_pattern = re.compile(r'^\s*elif\b')
 
+# deindented keyword -> characters triggering the deindentation when typed
+# (the lookup is in deindent_keywords)
+deindent_triggers = {
+    'else': ':',
+    'finally': ':',
+    'except': ' :',
+    'elif': ' ',
+}
+
+
+# view id -> True if the syntax of the view is python
+python_views = {}
+
+
+def is_python_view(view):
+    """Return True if the view uses the python syntax, cached per view."""
+    view_id = view.id()
+    is_python = python_views.get(view_id)
+    if is_python is None:
+        is_python = view.score_selector(0, 'source.python') > 0
+        python_views[view_id] = is_python
+        # the syntax is a view setting
+        settings = view.settings()
+        settings.clear_on_change('python_indent_syntax')
+        settings.add_on_change('python_indent_syntax',
+                               lambda: python_views.pop(view_id, None))
+    return is_python
+
 
 class PythonDeindenter(sublime_plugin.EventListener):
 
@@ -370,49 +1485,1748 @@ class PythonDeindenter(sublime_plugin.EventListener):
     def change_indent(self, str, new_indent):
         return indent_regex.sub(' '*new_indent, str, count=1)
 
+    def deindent_keyword(self, begin_line, characters):
+        """Return the keyword of the line to align with a previous block
+        (see deindent_keywords), or None if the line must not be deindented.
+
+        begin_line is the line up to the cursor, after characters were
+        typed.
+        """
+        keyword = deindent_keyword(begin_line)
+        if (keyword is not None and characters
+                and characters[-1] in deindent_triggers[keyword]):
+            return keyword
+        return None
+
+    @trace_recorder.traced('modified')
+    @stats.timed('PythonDeindenter.on_modified ms')
     def on_modified(self, view):
+        # called on the main thread for every keystroke in every view: the
+        # lock is only taken to deindent
+        if not is_python_view(view):
+            return
         cmd, param, count = view.command_history(0, False)
-        if cmd != 'insert' or param['characters'][-1] not in ': ':
+        if cmd != 'insert':
+            return
+        characters = param['characters']
+        if not characters or characters[-1] not in ': ':
             return
 
-        sel = view.sel()[0]  # XXX multi selection
-        begin_line = view.substr(sublime.Region(view.line(sel).begin(),
-                                                sel.end()))
-        # new_sel = []
-        if sel.empty():
-            pattern = ''
-            if else_pattern.match(begin_line):
-                if param['characters'].endswith(':'):
-                    pattern = 'else'
-                    align_with = ['if', 'except']
-                    ignore = ['elif']
-            elif finally_pattern.match(begin_line):
-                if param['characters'].endswith(':'):
-                    pattern = 'finally'
-                    align_with = ['try']
-                    ignore = ['except', 'else']
-            elif except_pattern.match(begin_line):
-                if (param['characters'].endswith(' ')
-                        or param['characters'].endswith(':')):
-                    pattern = 'except'
-                    align_with = ['try']
-                    ignore = ['except']
-            elif elif_pattern.match(begin_line):
-                if param['characters'].endswith(' '):
-                    pattern = 'elif'
-                    align_with = ['if']
-                    ignore = ['elif']
-
-            if pattern:
-                str_line = view.substr(view.line(sel))
-                indent = previous_keyword_lookup(view, sel.end(), align_with,
-                                                 ignore)
-                if indent is not -1:
+        with cache_lock:
+            # the listeners are called in any order: the line states may
+            # not be invalidated by LineStateTracker yet
+            invalidate_modified_line_states(view, cmd, param)
+
+            # all the lookups are done before modifying the view
+            lines = []
+            for sel in view.sel():
+                if not sel.empty():
+                    continue
+                line = view.line(sel)
+                if lines and lines[-1][0].begin() == line.begin():
+                    continue
+                keyword = self.deindent_keyword(
+                    view.substr(sublime.Region(line.begin(), sel.end())),
+                    characters)
+                if keyword is None:
+                    continue
+                indent = previous_keyword_lookup(view, sel.end(),
+                                                 *deindent_keywords[keyword])
+                if indent != -1:
+                    lines.append((line, indent))
+
+            if lines:
+                # sorted from the last line (see replace_lines)
+                edits = [(line.begin(), line.end(),
+                          self.change_indent(view.substr(line), indent))
+                         for line, indent in reversed(lines)]
+                if ASYNC_EVENTS:
+                    view.run_command('deindent_python_lines',
+                                     {'edits': edits})
+                else:
                     edit = view.begin_edit()
                     try:
-                        new_line = self.change_indent(str_line, indent)
-                        view.replace(edit, view.line(sel), new_line)
+                        replace_lines(view, edit, edits)
                     finally:
                         view.end_edit(edit)
 
+    def on_close(self, view):
+        python_views.pop(view.id(), None)
+        trace_recorder.forget(view.id())
+
+
+class DeindentPythonLines(sublime_plugin.TextCommand):
+    """Apply the edits of PythonDeindenter (sublime text 3 and later, where
+    the views are only modified by text commands)."""
+    @locked
+    def run(self, edit, edits):
+        replace_lines(self.view, edit, edits)
+
+
+# commands modifying the text at the cursors only
+cursor_commands = ('insert', 'left_delete', 'right_delete', 'new_python_line')
+# commands invalidating the line states they modify
+invalidating_commands = ('paste_python_lines', 'deindent_python_lines')
+
+
+def invalidate_modified_line_states(view, cmd, param):
+    """Invalidate the cached line states after a modification of the view.
+
+    Arguments
+    ---------
+    cmd, param: command of the modification, and its arguments.
+    """
+    cache = line_state_caches.get(view.buffer_id())
+    if cache is None or cmd in invalidating_commands:
+        return
+    modified = modified_range(view, cmd, param)
+    cache.invalidate(modified[0] if modified else 0, view.size())
+
+
+def modified_range(view, cmd, param):
+    """Return (begin, end), points of the view around the text modified by
+    the command cmd, or None if it cannot be known."""
+    if cmd == 'deindent_python_lines':
+        # sorted from the last line; the typed characters are on the lines
+        # of the cursors
+        edits = param['edits']
+        shift = sum(len(text) - (end - begin)
+                    for begin, end, text in edits[1:])
+        return (min(edits[-1][0], view.line(view.sel()[0]).begin()),
+                max(edits[0][0] + shift + len(edits[0][2]),
+                    view.sel()[-1].end()))
+    if cmd == 'paste_python_lines':
+        pasted = pasted_ranges.get(view.buffer_id())
+        if pasted is None or pasted[2] != view.size():
+            # modified since
+            return None
+        return pasted[:2]
+    if cmd == 'paste':
+        # the clipboard is pasted before the cursors, or before the start
+        # of their lines (whole lines copied without a selection)
+        begin = (view.line(min(region.begin() for region in view.sel()))
+                 .begin() - len(sublime.get_clipboard()))
+        return max(0, begin), max(region.end() for region in view.sel())
+    if cmd not in cursor_commands:
+        return None
+    begin = min(region.begin() for region in view.sel())
+    if cmd == 'insert':
+        begin -= len(param['characters'])
+    elif cmd == 'new_python_line':
+        # the new line character is inserted before the cursor
+        begin = view.line(begin).begin() - 1
+    return max(0, begin), max(region.end() for region in view.sel())
+
+
+class LineStateTracker(sublime_plugin.EventListener):
+
+    """Invalidate the cached line states on view modifications.
+
+    Always on the main thread: the states must be invalidated before the
+    next lookup, and the modification is found from the selections.
+    """
+
+    def on_modified(self, view):
+        # the lock is only taken for the views with cached line states
+        if view.buffer_id() not in line_state_caches:
+            return
+        cmd, param, count = view.command_history(0, False)
+        with cache_lock:
+            invalidate_modified_line_states(view, cmd, param)
+
+    @locked
+    def on_close(self, view):
+        buffer_caches.close(view)
+
+
+## background indexing
+
+# time slice of the background indexing, in seconds
+INDEX_SLICE = 0.01
+# time without modification of the views before the background indexing
+# resumes, in seconds
+INDEX_IDLE_DELAY = 0.5
+
+
+class IndexScheduler(object):
+    """Build the line state caches of the python views in the background.
+
+    The views are scanned by slices of INDEX_SLICE seconds, run through
+    run_later: on the main thread with sublime text 2, whose API cannot be
+    used from other threads, and off the main thread with later versions.
+    The first new line or deindent in a large view then finds its line
+    states already cached, or waits for one slice at most.
 
+    The active view is scanned first, and the scan pauses while the user is
+    typing: a slice only runs INDEX_IDLE_DELAY seconds after the last
+    modification.
+    """
+    def __init__(self):
+        # views left to scan, the active view first
+        self.views = []
+        self.active = None
+        self.last_modified = 0.0
+        self.scheduled = False
+
+    @locked
+    def add(self, view, active=False):
+        """Scan the view, before the other views if active is True."""
+        self.remove(view)
+        if active:
+            self.active = view.id()
+            self.views.insert(0, view)
+        else:
+            self.views.append(view)
+        self.schedule(0)
+
+    @locked
+    def remove(self, view):
+        view_id = view.id()
+        self.views = [v for v in self.views if v.id() != view_id]
+
+    @locked
+    def modified(self, view):
+        """Pause the scan, and scan the modified view again afterwards."""
+        self.last_modified = default_timer()
+        self.add(view, active=True)
+
+    def schedule(self, delay=INDEX_SLICE):
+        """Run the next slice after delay seconds, unless already planned."""
+        if self.views and not self.scheduled:
+            self.scheduled = True
+            run_later(self.run, int(delay * 1000))
+
+    @locked
+    def run(self):
+        """Run a slice of the scan of the first view."""
+        self.scheduled = False
+        if not self.views:
+            return
+        idle = default_timer() - self.last_modified
+        if idle < INDEX_IDLE_DELAY:
+            self.schedule(INDEX_IDLE_DELAY - idle)
+            return
+        if self.index(self.views[0], default_timer() + INDEX_SLICE):
+            self.views.pop(0)
+        self.schedule()
+
+    def index(self, view, deadline):
+        """Scan the view until deadline.
+
+        Return True once the line states of the whole view are cached.
+        """
+        if not background_indexing or not is_python_view(view):
+            return True
+        if view.id() != self.active and buffer_caches.exceeded():
+            # the inactive views would evict each other
+            return True
+        if stats.enabled:
+            stats.count('background index slices')
+        cache = get_line_state_cache(view)
+        return cache.scan(view, view.line(view.size()).begin(), deadline)
+
+
+index_scheduler = IndexScheduler()
+
+
+class BackgroundIndexer(sublime_plugin.EventListener):
+
+    """Schedule the background indexing of the python views.
+
+    With sublime text 3 and later, the asynchronous events are used.
+    """
+
+    def on_load(self, view):
+        if not ASYNC_EVENTS:
+            self.on_load_async(view)
+
+    def on_load_async(self, view):
+        if background_indexing and is_python_view(view):
+            index_scheduler.add(view)
+
+    def on_activated(self, view):
+        if not ASYNC_EVENTS:
+            self.on_activated_async(view)
+
+    def on_activated_async(self, view):
+        if background_indexing and is_python_view(view):
+            index_scheduler.add(view, active=True)
+
+    def on_modified(self, view):
+        if not ASYNC_EVENTS:
+            self.on_modified_async(view)
+
+    def on_modified_async(self, view):
+        if background_indexing and is_python_view(view):
+            index_scheduler.modified(view)
+
+    def on_close(self, view):
+        index_scheduler.remove(view)
+
+
+## paste and reindent
+
+def paste_edit(view, region, text):
+    """Return the edit pasting text over the region, reindented.
+
+    The state of the insertion point is found once, then the pasted lines
+    are reindented in a single forward pass (see reindent_lines): the first
+    one is indented up to the cursor, or as a new line following the
+    previous line if the cursor is at the start of its line, and the
+    following ones keep their position relative to it, unless the rules
+    set it. If the cursor follows some text on its line, the first line is
+    pasted after it unchanged.
+
+    Arguments
+    ---------
+    view: sublime.View
+    region: selected region, replaced by the pasted text.
+    text: pasted text.
+
+    Return
+    ------
+    (begin, end, text): replace the text between the points begin and end
+        with text.
+    """
+    tab_size = view.settings().get('tab_size')
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    line_begin = view.line(region.begin()).begin()
+    prefix = view.substr(sublime.Region(line_begin, region.begin()))
+
+    engine = IndentationEngine(tab_size)
+    row_state = get_line_state_cache(view).line_state(view, line_begin,
+                                                      lookup_deadline())
+    if row_state is None:
+        row_state = best_effort_line_state(view, line_begin, tab_size)
+    engine.row, engine.state = row_state
+
+    head = []
+    if prefix.strip() or engine.continuation() == 'string':
+        begin = region.begin()
+        head.append(lines.pop(0))
+        engine.feed(prefix + head[0])
+    else:
+        # the indentation of the cursor line is replaced
+        begin = line_begin
+        if prefix:
+            engine.new_indent = get_line_current_indent(prefix, tab_size)
+        elif line_begin:
+            engine.new_indent = get_new_line_indent(view, line_begin - 1)
+        keyword = deindent_keyword(lines[0])
+        if keyword is not None:
+            indent = previous_keyword_lookup(
+                view, line_begin, deindent_keywords[keyword][0],
+                deindent_keywords[keyword][1], engine.new_indent)
+            if indent != -1:
+                engine.new_indent = indent
+    # the first reindented line is indented as a new line
+    engine.opens_block = True
+
+    old = 0
+    for line in lines:
+        if line.strip():
+            old = get_line_current_indent(line, tab_size)
+            break
+    lines = head + list(reindent_lines(lines, tab_size, engine,
+                                       engine.new_indent - old))
+    if begin == line_begin and not lines[-1]:
+        # the text after the cursor keeps its indentation
+        lines[-1] = prefix
+    return begin, region.end(), '\n'.join(lines)
+
+
+# buffer id -> (begin, end, size of the view) after the last
+# paste_python_lines command
+pasted_ranges = {}
+
+
+class PastePythonLines(sublime_plugin.TextCommand):
+    """Paste the clipboard, reindented for the position of the cursors.
+
+    Each selection is replaced at once, in a single edit (one undo step).
+
+    """
+    @stats.timed('PastePythonLines.run ms')
+    @locked
+    def run(self, edit):
+        text = sublime.get_clipboard()
+        try:
+            edits = []
+            for region in sorted(self.view.sel(), key=lambda r: r.begin()):
+                begin, end, new_text = paste_edit(self.view, region, text)
+                if edits and begin < edits[-1][1]:
+                    # the indentation is shared with the previous cursor
+                    begin, new_text = region.begin(), text
+                edits.append((begin, end, new_text))
+
+            if edits:
+                replace_lines(self.view, edit, edits[::-1])
+
+            self.view.sel().clear()
+            shift = 0
+            for begin, end, new_text in edits:
+                shift += len(new_text) - (end - begin)
+                self.view.sel().add(sublime.Region(end + shift, end + shift))
+            if edits:
+                pasted_ranges[self.view.buffer_id()] = (
+                    edits[0][0], edits[-1][1] + shift, self.view.size())
+        except:
+            # fail safe
+            print(traceback.format_exc())
+            for sel in reversed(self.view.sel()):
+                self.view.replace(edit, sel, text)
+
+
+## misindentation markers
+
+# number of lines between two snapshots of the IndentChecker engine
+CHECKPOINT_LINES = 32
+
+
+def _relative_state(state, row, shift):
+    """Return state with the rows of its brackets and statement shifted."""
+    if state == EMPTY_LINE_STATE:
+        return state
+    string, brackets = state
+    if string is not None:
+        string = (string[0], string[1] + shift, string[2])
+    return string, tuple((b[0], b[1] + shift, b[2], b[3] + shift, b[4])
+                         for b in brackets)
+
+
+def _lines_hash(lines):
+    """Return the hash of the lines, as computed by IndentChecker.update."""
+    h = 0
+    for line in lines:
+        h = hash((h, line))
+    return h
+
+
+class IndentChecker(object):
+    """Misindented lines of a view (see check_lines), updated after each
+    modification.
+
+    The IndentationEngine is saved every CHECKPOINT_LINES lines. After a
+    modification, the lines are checked again from the last snapshot
+    preceding it, until the engine converges: past the modified lines, as
+    soon as its state is the same as a previous snapshot of the same line,
+    the following lines are known to be unchanged. The rows in the
+    snapshots are relative to their line, so that they stay valid when
+    lines are inserted or removed before.
+
+    A check running out of time stops at a pending row, up to which the
+    lines are checked: the following modifications converge against the
+    snapshots preceding it, and only resume checks the lines past it.
+
+    The hash of the lines between two snapshots is also kept, to locate the
+    modifications whose lines are not known (undo...).
+
+    """
+    def __init__(self, tab_size):
+        self.tab_size = tab_size
+        # rows of the snapshots, and the snapshots
+        self.rows = array('i', [0])
+        self.snapshots = [self.snapshot(IndentationEngine(tab_size))]
+        # hashes of the lines from each snapshot to the next one (see
+        # _lines_hash)
+        self.hashes = [0]
+        # sorted rows of the misindented lines
+        self.misindented = array('i')
+        self.line_count = 1
+        # row from which the lines are not checked yet, if the last update
+        # ran out of time
+        self.pending = None
+        # ids of the views showing the current markers
+        self.views = set()
+        # whether resume is planned
+        self.scheduled = False
+
+    # estimated size of a snapshot, in bytes
+    snapshot_bytes = 600
+
+    def memory(self):
+        """Return the estimated size of the checker, in bytes."""
+        return ((len(self.rows) + len(self.misindented)) * 4
+                + len(self.snapshots) * self.snapshot_bytes)
+
+    def locate(self, view):
+        """Return (first_row, last_row), rows of the view around the lines
+        modified since the last update, found by comparing the hashes of the
+        lines between the snapshots from both ends of the view."""
+        lines = view.substr(sublime.Region(0, view.size())).split('\n')
+        rows, hashes = self.rows, self.hashes
+        checked = self.line_count if self.pending is None else self.pending
+        ends = rows[1:] + array('i', [checked])
+        first_row = min(checked, len(lines) - 1)
+        for j in xrange(len(rows)):
+            if _lines_hash(lines[rows[j]:ends[j]]) != hashes[j]:
+                first_row = rows[j]
+                break
+        last_row = len(lines) - 1
+        if self.pending is None:
+            delta = len(lines) - self.line_count
+            for j in xrange(len(rows) - 1, -1, -1):
+                begin = rows[j] + delta
+                if (begin <= first_row or _lines_hash(
+                        lines[begin:ends[j] + delta]) != hashes[j]):
+                    break
+                last_row = begin - 1
+        return first_row, max(first_row, last_row)
+
+    def snapshot(self, engine):
+        row = engine.row
+        return (_relative_state(engine.state, row, -row),
+                engine.backslash, tuple(engine.keywords.lines),
+                engine.new_indent, engine.opens_block, engine.stmt_kind,
+                engine.stmt_indent,
+                tuple(sorted((r - row, opener)
+                             for r, opener in engine.openers.items())))
+
+    def restore(self, snapshot, row):
+        engine = IndentationEngine(self.tab_size)
+        engine.row = row
+        engine.state = _relative_state(snapshot[0], 0, row)
+        engine.keywords.lines = list(snapshot[2])
+        (engine.backslash, engine.new_indent, engine.opens_block,
+         engine.stmt_kind, engine.stmt_indent) = snapshot[1], snapshot[3], \
+            snapshot[4], snapshot[5], snapshot[6]
+        engine.openers = dict((r + row, opener) for r, opener in snapshot[7])
+        return engine
+
+    def update(self, view, first_row, last_row, deadline=None):
+        """Check the lines again after a modification of the view.
+
+        Arguments
+        ---------
+        first_row, last_row: first and last rows of the modified lines, in
+            the view after the modification (the whole view after a
+            modification that cannot be located).
+        deadline: if the check lasts past deadline (default timer), it
+            stops, and the remaining lines are checked by the next update.
+
+        Return
+        ------
+        (first_row, end_row, changed): range of rows checked again, and
+        whether the misindented lines of the view changed, apart from their
+        rows shifted by the modification.
+        """
+        line_count = view.rowcol(view.size())[0] + 1
+        delta = line_count - self.line_count
+        self.line_count = line_count
+        pending = limit = self.pending
+        if pending is not None:
+            if first_row >= pending:
+                # the lines past the pending row are checked by resume
+                return first_row, first_row, False
+            # the lines following the modified ones are checked up to the
+            # pending row, if the engine does not converge before
+            limit = max(pending + delta, last_row + 1)
+            self.pending = None
+        old_last = last_row - delta
+
+        rows, snapshots = self.rows, self.snapshots
+        i = bisect_right(rows, first_row) - 1
+        start_row = rows[i]
+        engine = self.restore(snapshots[i], start_row)
+        new_rows = array('i')
+        new_snapshots = []
+        # the snapshots following the modified lines (rows before the
+        # modification) are compared to the engine to detect the convergence
+        c = bisect_right(rows, old_last)
+        found = array('i')
+        new_hashes = []
+        lines_hash = 0
+        end_row = None
+        tab_size = self.tab_size
+        countdown = CHECKPOINT_LINES
+        row = start_row
+        for line in self.iter_lines(view, start_row):
+            if row > start_row:
+                if row > last_row:
+                    while c < len(rows) and rows[c] + delta < row:
+                        c += 1
+                    if (c < len(rows) and rows[c] + delta == row
+                            and self.snapshot(engine) == snapshots[c]):
+                        end_row = row
+                        break
+                if row == limit:
+                    self.pending = end_row = row
+                    break
+                if row - (new_rows[-1] if new_rows else start_row) >= \
+                        CHECKPOINT_LINES:
+                    new_rows.append(row)
+                    new_snapshots.append(self.snapshot(engine))
+                    new_hashes.append(lines_hash)
+                    lines_hash = 0
+                countdown -= 1
+                if not countdown:
+                    if deadline is not None and default_timer() > deadline:
+                        self.pending = end_row = row
+                        break
+                    countdown = CHECKPOINT_LINES
+            lines_hash = hash((lines_hash, line))
+            if engine.misindented(line) is not None:
+                found.append(row)
+            row += 1
+        new_hashes.append(lines_hash)
+        converged = end_row is not None and self.pending is None
+        if end_row is None:
+            end_row = row
+        elif converged and pending is not None:
+            self.pending = pending + delta
+
+        # replace the snapshots and misindented lines checked again, and
+        # shift the following ones
+        misindented = self.misindented
+        k = bisect_left(misindented, start_row)
+        if converged:
+            m = bisect_left(misindented, end_row - delta)
+        else:
+            c = len(rows)
+            m = len(misindented)
+        previous = misindented[k:m]
+        if delta:
+            # the misindented lines among the modified ones changed
+            changed = (bisect_right(previous, old_last)
+                       != bisect_left(previous, first_row))
+            shifted = array('i', (r if r < first_row else r + delta
+                                  for r in previous
+                                  if r < first_row or r > old_last))
+            changed = changed or shifted != found
+        else:
+            changed = previous != found
+        misindented[k:m] = found
+        rows[i + 1:c] = new_rows
+        snapshots[i + 1:c] = new_snapshots
+        self.hashes[i:c] = new_hashes
+        if delta and converged:
+            tail = k + len(found)
+            misindented[tail:] = array('i', (r + delta
+                                             for r in misindented[tail:]))
+            tail = i + 1 + len(new_rows)
+            rows[tail:] = array('i', (r + delta for r in rows[tail:]))
+        return start_row, end_row, changed
+
+    def resume(self, view, deadline=None):
+        """Check the lines from the pending row, as update."""
+        row, self.pending = self.pending, None
+        return self.update(view, row, row, deadline)
+
+    def iter_lines(self, view, row):
+        """Yield the lines of the view from row to the end."""
+        point = view.text_point(row, 0)
+        size = view.size()
+        for line in iter_view_lines(view, point, size):
+            point += len(line) + 1
+            yield line
+        yield view.substr(sublime.Region(point, size))
+
+
+# buffer id -> IndentChecker
+indent_checkers = {}
+buffer_caches.register(indent_checkers)
+# buffer id -> (first_row, last_row, line count) of the lines modified since
+# the last update of the markers (last_row None: the whole buffer)
+modified_rows = {}
+
+
+def draw_indent_markers(view, checker):
+    view.add_regions(
+        'python_indent_misindented',
+        [view.line(view.text_point(row, 0)) for row in checker.misindented],
+        'invalid', 'dot', sublime.DRAW_EMPTY | sublime.DRAW_OUTLINED)
+
+
+def record_modification(view, modified):
+    """Add the points modified, (begin, end) or None if unknown, to the
+    modified_rows of the buffer of the view."""
+    line_count = view.rowcol(view.size())[0]
+    if modified is None:
+        first_row, last_row = 0, None
+    else:
+        first_row = view.rowcol(modified[0])[0]
+        last_row = view.rowcol(modified[1])[0]
+    previous = modified_rows.get(view.buffer_id())
+    if previous is not None:
+        old_first, old_last, old_count = previous
+        if last_row is None or old_last is None:
+            first_row, last_row = 0, None
+        else:
+            if old_last >= first_row:
+                # shifted by the lines added or removed since
+                old_last = max(first_row, old_last + line_count - old_count)
+            first_row = min(first_row, old_first)
+            last_row = max(last_row, old_last)
+    modified_rows[view.buffer_id()] = (first_row, last_row, line_count)
+
+
+@checker_locked
+def update_indent_markers(view, first_row=0, last_row=None):
+    """Check the modified lines of the view (last_row None: unknown), and
+    update its markers."""
+    tab_size = view.settings().get('tab_size')
+    with cache_lock:
+        buffer_id = buffer_caches.use(view)
+        checker = indent_checkers.get(buffer_id)
+        new = checker is None or checker.tab_size != tab_size
+        if new:
+            checker = indent_checkers[buffer_id] = IndentChecker(tab_size)
+    if new:
+        first_row, last_row = 0, view.rowcol(view.size())[0]
+    elif last_row is None:
+        first_row, last_row = checker.locate(view)
+    changed = checker.update(view, first_row, last_row, lookup_deadline())[2]
+    show_indent_markers(view, checker, changed)
+
+
+@checker_locked
+def resume_indent_markers(view):
+    """Check the lines of the view following the pending row of its
+    IndentChecker, for INDEX_SLICE seconds."""
+    with cache_lock:
+        checker = indent_checkers.get(view.buffer_id())
+        if checker is None:
+            return
+        checker.scheduled = False
+        if checker.pending is None or view.buffer_id() in modified_rows:
+            # the check of the modification resumes afterwards
+            return
+        buffer_caches.use(view)
+    changed = checker.resume(view, default_timer() + INDEX_SLICE)[2]
+    show_indent_markers(view, checker, changed)
+
+
+def show_indent_markers(view, checker, changed):
+    """Draw the markers of the view if changed, and plan the check of the
+    remaining lines."""
+    if changed:
+        # the clones draw the new markers when activated
+        checker.views.clear()
+    if view.id() not in checker.views:
+        draw_indent_markers(view, checker)
+        checker.views.add(view.id())
+    if checker.pending is not None and not checker.scheduled:
+        checker.scheduled = True
+        run_later(lambda: resume_indent_markers(view), 10)
+
+
+# time without modification of a view before its modified lines are checked
+# with sublime text 2, in seconds
+MARKERS_IDLE_DELAY = 0.2
+# buffer id -> number of modifications (sublime text 2)
+modification_counts = {}
+
+
+class MisindentationMarkers(sublime_plugin.EventListener):
+
+    """Mark the misindented lines of python views in the gutter.
+
+    The modified lines are recorded on the main thread, and checked in
+    on_modified_async with sublime text 3 and later. With sublime text 2,
+    they are checked once the user stops typing for MARKERS_IDLE_DELAY.
+    """
+
+    def on_activated(self, view):
+        if not ASYNC_EVENTS:
+            self.on_activated_async(view)
+
+    @checker_locked
+    def on_activated_async(self, view):
+        if not misindentation_markers or not is_python_view(view):
+            return
+        with cache_lock:
+            checker = indent_checkers.get(view.buffer_id())
+        if checker is None:
+            update_indent_markers(view)
+        elif view.id() not in checker.views:
+            # a clone of the view
+            draw_indent_markers(view, checker)
+            checker.views.add(view.id())
+
+    def on_modified(self, view):
+        buffer_id = view.buffer_id()
+        if not misindentation_markers:
+            if buffer_id in indent_checkers:
+                with cache_lock:
+                    modified_rows.pop(buffer_id, None)
+                    indent_checkers.pop(buffer_id, None)
+                view.erase_regions('python_indent_misindented')
+            return
+        if not is_python_view(view):
+            return
+        if buffer_id in indent_checkers:
+            cmd, param, count = view.command_history(0, False)
+            with cache_lock:
+                record_modification(view, modified_range(view, cmd, param))
+        if not ASYNC_EVENTS:
+            count = modification_counts[buffer_id] = \
+                modification_counts.get(buffer_id, 0) + 1
+            run_later(lambda: self.on_idle(view, count),
+                      int(MARKERS_IDLE_DELAY * 1000))
+
+    def on_idle(self, view, count):
+        """Check the modified lines, unless the view was modified again
+        since the modification count."""
+        if modification_counts.get(view.buffer_id()) == count:
+            self.on_modified_async(view)
+
+    @checker_locked
+    def on_modified_async(self, view):
+        if not misindentation_markers or not is_python_view(view):
+            return
+        buffer_id = view.buffer_id()
+        with cache_lock:
+            modified = modified_rows.pop(buffer_id, None)
+            checked = buffer_id in indent_checkers
+        if not checked:
+            update_indent_markers(view)
+        elif modified is not None:
+            update_indent_markers(view, modified[0], modified[1])
+
+    @locked
+    def on_close(self, view):
+        buffer_caches.close(view)
+        if view.buffer_id() not in indent_checkers:
+            modified_rows.pop(view.buffer_id(), None)
+            modification_counts.pop(view.buffer_id(), None)
+            pasted_ranges.pop(view.buffer_id(), None)
+
+
+## statistics
+
+class ShowPythonIndentStatsCommand(sublime_plugin.WindowCommand):
+    """Show the instrumentation statistics in an output panel.
+
+    With a file argument, the statistics are written to this file as JSON
+    instead. With reset, the statistics are cleared afterwards.
+
+    """
+    def run(self, file=None, reset=False):
+        if file:
+            data = stats.to_dict()
+            data['line scan cache'] = line_scans.to_dict()
+            with open(os.path.expanduser(file), 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+        else:
+            text = ('line scan cache: %(lines)d/%(size)d lines, %(hits)d hits, '
+                    '%(misses)d misses\n\n' % line_scans.to_dict())
+            if stats.enabled:
+                text += stats.format()
+            else:
+                text += ('Python Indent: instrumentation is disabled, set '
+                         '"instrumentation" to true in '
+                         'python_indent.sublime-settings.\n')
+            panel = self.window.get_output_panel('python_indent_stats')
+            if ASYNC_EVENTS:
+                panel.run_command('select_all')
+                panel.run_command('right_delete')
+                panel.run_command('append', {'characters': text})
+            else:
+                edit = panel.begin_edit()
+                try:
+                    panel.erase(edit, sublime.Region(0, panel.size()))
+                    panel.insert(edit, 0, text)
+                finally:
+                    panel.end_edit(edit)
+            self.window.run_command('show_panel',
+                                    {'panel': 'output.python_indent_stats'})
+        if reset:
+            stats.reset()
+
+
+## editor independent engine
+
+
+# deindented keyword: (keywords to align with, keywords to ignore)
+deindent_keywords = {
+    'else': (('if', 'except', 'for', 'while'), ('elif',)),
+    'finally': (('try',), ('except', 'else')),
+    'except': (('try',), ('except',)),
+    'elif': (('if',), ('elif',)),
+}
+# first words that can be searched or ignored by previous_keyword_lookup
+lookup_keywords = frozenset(('if', 'elif', 'else', 'try', 'except', 'for',
+                             'while'))
+
+
+def deindent_keyword(line):
+    """Return the keyword of a line to align with a previous block, or None."""
+    if else_pattern.match(line):
+        return 'else'
+    elif finally_pattern.match(line):
+        return 'finally'
+    elif except_pattern.match(line):
+        return 'except'
+    elif elif_pattern.match(line):
+        return 'elif'
+    return None
+
+
+class KeywordStack(object):
+    """Forward equivalent of previous_keyword_lookup.
+
+    Keep only the previous lines that can still be found or limit the
+    indentation of a lookup: a line hides the previous lines with a greater
+    or equal indentation, unless it can be searched or ignored. The stack size
+    is bounded by the number of indentation levels.
+
+    """
+    def __init__(self, tab_size=4):
+        self.tab_size = tab_size
+        self.lines = []
+
+    def add(self, line):
+        """Add the next line."""
+        stripped = line.lstrip()
+        if not stripped or stripped[0] == '#':
+            return
+        indent = get_line_current_indent(line, self.tab_size)
+        word = first_word_regex.match(line).group(1)
+        if word in lookup_keywords:
+            self.lines = [l for l in self.lines
+                          if l[0] != indent or l[1] != word]
+        else:
+            word = None
+            self.lines = [l for l in self.lines if l[0] < indent]
+        self.lines.append((indent, word))
+
+    def lookup(self, keywords, ignore, max_indent):
+        """Same as previous_keyword_lookup, for a line following the lines
+        added, with the given indentation."""
+        for indent, word in reversed(self.lines):
+            if word in keywords:
+                if indent <= max_indent:
+                    return indent
+            elif word not in ignore:
+                max_indent = min(indent - self.tab_size, max_indent)
+                if max_indent < 0:
+                    return -1
+        return -1
+
+
+class LineState(namedtuple('LineState', 'indent depth kind continuation')):
+    """State of a line, as yielded by iter_line_states.
+
+    indent: expected indentation of the line, or None if the rules leave it
+        free (blank or comment line, line inside a multi-line string, dedent
+        after a statement).
+    depth: number of brackets open at the start of the line.
+    kind: kind of statement of the line, as returned by line_kind.
+    continuation: None for a new statement, or how the line continues the
+        previous one: 'bracket', 'string' or 'backslash'.
+
+    """
+    __slots__ = ()
+
+
+class IndentationEngine(object):
+    """Indentation rules applied forward to a stream of lines.
+
+    The memory used only depends on the nesting depth of the code.
+
+    """
+    def __init__(self, tab_size=4):
+        self.tab_size = tab_size
+        self.row = 0
+        self.state = EMPTY_LINE_STATE
+        self.backslash = False
+        self.keywords = KeywordStack(tab_size)
+        # indentation of a new line following the last non-blank line
+        self.new_indent = 0
+        # whether the last statement ends with the start of a block
+        self.opens_block = False
+        self.stmt_kind = None
+        # indentation of the first line of the last statement
+        self.stmt_indent = 0
+        # row -> (indentation, hanging) of the lines opening the brackets
+        # still open; hanging is the number of brackets opened on the line if
+        # the last one ends it, 0 otherwise
+        self.openers = {}
+
+    def continuation(self):
+        """Return how the next line continues the previous one, or None."""
+        string, brackets = self.state
+        if string is not None:
+            return 'string'
+        elif brackets:
+            return 'bracket'
+        elif self.backslash:
+            return 'backslash'
+        return None
+
+    def expected_indent(self, line, continuation=None):
+        """Return the expected indentation of the next line, or None."""
+        if continuation is None:
+            continuation = self.continuation()
+        stripped = line.strip()
+        if continuation == 'bracket':
+            return self.new_indent if stripped else None
+        elif continuation is not None or not stripped or stripped[0] == '#':
+            return None
+
+        keyword = deindent_keyword(line)
+        if keyword is not None:
+            indent = self.keywords.lookup(
+                deindent_keywords[keyword][0], deindent_keywords[keyword][1],
+                get_line_current_indent(line, self.tab_size))
+            return indent if indent != -1 else None
+        elif self.opens_block:
+            return self.new_indent
+        return None
+
+    def hanging(self, bracket):
+        """Return whether the open bracket is the last character of the
+        line opening it (comment excluded)."""
+        opener = self.openers.get(bracket[1])
+        if opener is None or not opener[1]:
+            return False
+        row_brackets = [b for b in self.state[1] if b[1] == bracket[1]]
+        return len(row_brackets) == opener[1] and row_brackets[-1] == bracket
+
+    def accepts_indent(self, line, indent):
+        """Return whether the next line, continuing a bracket, may have the
+        given indentation besides the expected one.
+
+        A line starting with a closing bracket may be aligned with the line
+        of the opening bracket, or with the opening bracket itself, the lines
+        inside a hanging bracket may be indented deeper than the statement,
+        and the lines aligned with a bracket of a block statement may be
+        indented once more, to tell them from the block.
+        """
+        brackets = self.state[1]
+        stripped = line.lstrip()
+        if (self.state[0] is not None or not brackets or not stripped
+                or stripped[0] == '#'):
+            return False
+        if stripped[0] in matching_brackets:
+            opening = matching_brackets[stripped[0]]
+            for bracket in reversed(brackets):
+                if bracket[0] == opening:
+                    opener = self.openers.get(bracket[1])
+                    if opener is not None and opener[0] == indent:
+                        return True
+                    if (indent == bracket[2] - 1
+                            and not self.hanging(bracket)):
+                        return True
+                    break
+        if self.hanging(brackets[-1]):
+            return indent > self.stmt_indent
+        return (self.stmt_kind == 'block'
+                and indent == brackets[-1][2] + self.tab_size)
+
+    def misindented(self, line):
+        """Process the next line, as feed, and return its expected
+        indentation if the line is misindented, or None."""
+        indent = get_line_current_indent(line, self.tab_size)
+        # before feed, which drops the brackets closed by the line
+        accepted = self.state[1] and self.accepts_indent(line, indent)
+        expected = self.feed(line).indent
+        if expected is None or expected == indent or accepted:
+            return None
+        return expected
+
+    def feed(self, line):
+        """Process the next line and return its LineState."""
+        continuation = self.continuation()
+        string, brackets = self.state
+        indent = self.expected_indent(line, continuation)
+
+        scan = line_scans.scan(line, self.tab_size, string and string[0])
+        self.state, new_indent = apply_line_scan(scan, self.row, self.state,
+                                                 self.tab_size)
+        if scan[2] and self.openers:
+            rows = set(b[1] for b in self.state[1])
+            for row in [r for r in self.openers if r not in rows]:
+                del self.openers[row]
+        opening = scan[3]
+        if opening:
+            # a comment may follow a hanging bracket
+            ends = not line[opening[-1][1] + 1:scan[4]].strip()
+            self.openers[self.row] = (scan[0], len(opening) if ends else 0)
+        self.row += 1
+        if continuation is None:
+            self.keywords.add(line)
+
+        if continuation is None:
+            self.stmt_kind = scan[1]
+            self.stmt_indent = scan[0]
+        if continuation == 'backslash' and self.state == EMPTY_LINE_STATE:
+            # the new line follows the first line of the statement
+            new_indent = self.new_indent
+        backslash = line_backslash(line, scan)
+        if backslash is not None:
+            self.new_indent = new_indent
+            self.backslash = backslash
+            self.opens_block = (self.stmt_kind == 'block'
+                                and self.state == EMPTY_LINE_STATE
+                                and line[:scan[4]].rstrip().endswith(':'))
+        return LineState(indent, len(brackets), scan[1], continuation)
+
+
+def iter_line_states(lines, tab_size=4):
+    """Yield the LineState of each line, in a single forward pass.
+
+    Arguments
+    ---------
+    lines: iterable of lines, with or without their end of line characters.
+    tab_size: tabs are count as 'tab_size' spaces (default 4).
+
+    """
+    engine = IndentationEngine(tab_size)
+    for line in lines:
+        yield engine.feed(line.rstrip('\r\n'))
+
+
+## language server
+
+class TextRegion(namedtuple('TextRegion', 'a b')):
+    """sublime.Region of a Document."""
+    __slots__ = ()
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def empty(self):
+        return self.a == self.b
+
+
+def line_breaks(text, offset=0):
+    """Return the points following the new line characters of text."""
+    points = []
+    i = text.find('\n')
+    while i != -1:
+        points.append(offset + i + 1)
+        i = text.find('\n', i + 1)
+    return points
+
+
+class Document(object):
+    """Text buffer with the methods of sublime.View used by the rules.
+
+    Lines are found by bisecting the line starts. An edit shifts the starts
+    of all the following lines: the shift is kept pending for the lines
+    after shift_row, and only applied to the lines between two consecutive
+    edits, so that typing at one place costs O(log n) per keystroke.
+
+    """
+    # the caches are keyed by buffer id: the other views used outside of
+    # sublime text take their ids from the same counter
+    ids = itertools.count(1)
+
+    def __init__(self, text, tab_size=4):
+        self.text = text
+        self.id_ = next(self.ids)
+        self.settings_ = {'tab_size': tab_size}
+        self.line_starts = [0] + line_breaks(text)
+        self.shift_row = len(self.line_starts)
+        self.shift = 0
+
+    def id(self):
+        return self.id_
+
+    def buffer_id(self):
+        return self.id_
+
+    def size(self):
+        return len(self.text)
+
+    def settings(self):
+        return self.settings_
+
+    def _start(self, row):
+        if row >= len(self.line_starts):
+            return len(self.text) + 1
+        if row >= self.shift_row:
+            return self.line_starts[row] + self.shift
+        return self.line_starts[row]
+
+    def _row(self, point):
+        starts = self.line_starts
+        if self.shift_row < len(starts) and point >= self._start(
+                self.shift_row):
+            return bisect_right(starts, point - self.shift,
+                                self.shift_row) - 1
+        return bisect_right(starts, point, 0, self.shift_row) - 1
+
+    def line(self, region):
+        if isinstance(region, (int, long)):
+            begin = end = region
+        else:
+            begin, end = min(region[0], region[1]), max(region[0], region[1])
+        return TextRegion(self._start(self._row(begin)),
+                          self._start(self._row(end) + 1) - 1)
+
+    def substr(self, region):
+        if isinstance(region, (int, long)):
+            return self.text[region:region + 1]
+        return self.text[region[0]:region[1]]
+
+    def rowcol(self, point):
+        row = self._row(point)
+        return row, point - self._start(row)
+
+    def text_point(self, row, col):
+        """Return the point of the column col of the line row, clamped to
+        the text."""
+        if row >= len(self.line_starts):
+            return len(self.text)
+        return min(self._start(row) + col, self._start(row + 1) - 1)
+
+    def edit(self, begin, end, string):
+        """Replace the text between the points begin and end with string."""
+        starts = self.line_starts
+        first, last = self._row(begin), self._row(end)
+        # the lines up to the last edited one get their exact start, the
+        # following ones the pending shift
+        if self.shift_row <= last:
+            for row in xrange(self.shift_row, last + 1):
+                starts[row] += self.shift
+        else:
+            for row in xrange(last + 1, min(self.shift_row, len(starts))):
+                starts[row] -= self.shift
+        new_starts = line_breaks(string, begin)
+        starts[first + 1:last + 1] = new_starts
+        self.shift_row = first + 1 + len(new_starts)
+        self.shift += len(string) - (end - begin)
+        self.text = self.text[:begin] + string + self.text[end:]
+
+
+def _lsp_text(text):
+    # the lines of the protocol also end with '\r\n' or '\r'
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+# characters counting as two UTF-16 code units; None if the python strings
+# already count them so (narrow python 2 builds)
+if sys.maxunicode > 0xffff:
+    astral_regex = re.compile(u'[\U00010000-\U0010ffff]')
+else:
+    astral_regex = None
+
+
+def _utf16_column(line, units):
+    """Return the index in line of the column counted in UTF-16 code
+    units."""
+    if astral_regex is None or not astral_regex.search(line):
+        return units
+    col = 0
+    for c in line:
+        if units <= 0:
+            break
+        units -= 2 if c > u'\uffff' else 1
+        col += 1
+    return col
+
+
+class IndentServer(object):
+    """Language server answering textDocument/onTypeFormatting on stdio.
+
+    The protocol is the subset of the Language Server Protocol (JSON-RPC
+    messages with Content-Length headers) needed by an editor to indent new
+    lines and deindent 'else', 'elif', 'except' and 'finally':
+
+    - textDocument/didOpen, didChange (incremental or full) and didClose
+      keep a Document per uri, with its LineStateCache: an edit only
+      invalidates the line states following it.
+    - textDocument/onTypeFormatting, after a new line, returns the edit
+      indenting the new line (get_new_line_indent); after ':' or ' ',
+      the edit deindenting the line (previous_keyword_lookup).
+
+    Positions are counted in UTF-16 code units, the default of the
+    protocol, or in characters if the client accepts the 'utf-32'
+    position encoding.
+
+    """
+    handlers = {
+        'initialize': 'initialize',
+        'shutdown': 'shutdown',
+        'exit': 'exit',
+        'textDocument/didOpen': 'did_open',
+        'textDocument/didChange': 'did_change',
+        'textDocument/didClose': 'did_close',
+        'textDocument/onTypeFormatting': 'on_type_formatting',
+    }
+
+    def __init__(self, input, output, tab_size=4):
+        self.input = input
+        self.output = output
+        self.tab_size = tab_size
+        # uri -> Document
+        self.documents = {}
+        self.deindenter = PythonDeindenter()
+        self.running = True
+        self.shutdown_requested = False
+        # whether the positions count UTF-16 code units
+        self.utf16 = True
+
+    def read_message(self):
+        """Return the next message, or None at the end of the input."""
+        length = None
+        while True:
+            header = self.input.readline()
+            if not header:
+                return None
+            header = header.strip()
+            if not header:
+                if length is not None:
+                    break
+                continue
+            name, _, value = header.decode('ascii').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        return json.loads(self.input.read(length).decode('utf-8'))
+
+    def send(self, message):
+        message['jsonrpc'] = '2.0'
+        body = json.dumps(message, separators=(',', ':')).encode('utf-8')
+        self.output.write(('Content-Length: %d\r\n\r\n'
+                           % len(body)).encode('ascii') + body)
+        self.output.flush()
+
+    def serve(self):
+        """Answer the messages until exit; return the exit status."""
+        while self.running:
+            message = self.read_message()
+            if message is None:
+                break
+            self.handle(message)
+        return 0 if self.shutdown_requested else 1
+
+    def handle(self, message):
+        method = message.get('method')
+        if method is None:
+            # response to a request of the server: none are sent
+            return
+        handler = self.handlers.get(method)
+        is_request = 'id' in message
+        if handler is None:
+            if is_request:
+                self.send({'id': message['id'], 'error': {
+                    'code': -32601, 'message': 'unknown method %s' % method}})
+            return
+        try:
+            result = getattr(self, handler)(message.get('params') or {})
+        except Exception:
+            if not is_request:
+                # stdout is the output of the messages
+                traceback.print_exc()
+                return
+            self.send({'id': message['id'], 'error': {
+                'code': -32603, 'message': traceback.format_exc()}})
+        else:
+            if is_request:
+                self.send({'id': message['id'], 'result': result})
+
+    def initialize(self, params):
+        encodings = (params.get('capabilities', {}).get('general', {})
+                     .get('positionEncodings') or [])
+        self.utf16 = 'utf-32' not in encodings
+        return {
+            'capabilities': {
+                'positionEncoding': 'utf-16' if self.utf16 else 'utf-32',
+                # open, close and incremental changes
+                'textDocumentSync': {'openClose': True, 'change': 2},
+                'documentOnTypeFormattingProvider': {
+                    'firstTriggerCharacter': '\n',
+                    'moreTriggerCharacter': [':', ' ']},
+            },
+            'serverInfo': {'name': 'python_indent'},
+        }
+
+    def shutdown(self, params):
+        self.shutdown_requested = True
+        return None
+
+    def exit(self, params):
+        self.running = False
+
+    def did_open(self, params):
+        document = params['textDocument']
+        self.did_close(params)
+        self.documents[document['uri']] = Document(
+            _lsp_text(document['text']), self.tab_size)
+
+    def point(self, document, position):
+        """Return the point of the document at the LSP position."""
+        row, col = position['line'], position['character']
+        if self.utf16 and col:
+            line = document.substr(document.line(document.text_point(row, 0)))
+            col = _utf16_column(line, col)
+        return document.text_point(row, col)
+
+    def did_change(self, params):
+        document = self.documents[params['textDocument']['uri']]
+        for change in params['contentChanges']:
+            text = _lsp_text(change['text'])
+            if 'range' in change:
+                begin = self.point(document, change['range']['start'])
+                document.edit(begin, self.point(
+                    document, change['range']['end']), text)
+            else:
+                begin = 0
+                document.edit(0, document.size(), text)
+            invalidate_line_states(document, begin)
+
+    def did_close(self, params):
+        document = self.documents.pop(params['textDocument']['uri'], None)
+        if document is not None:
+            buffer_caches.close(document)
+
+    def on_type_formatting(self, params):
+        document = self.documents[params['textDocument']['uri']]
+        tab_size = params.get('options', {}).get('tabSize')
+        if tab_size:
+            document.settings_['tab_size'] = tab_size
+        position = params['position']
+        point = self.point(document, position)
+        line = document.line(point)
+        if params['ch'] == '\n':
+            if line.begin() == 0:
+                return []
+            indent = get_new_line_indent(document, line.begin() - 1)
+        else:
+            keyword = self.deindenter.deindent_keyword(
+                document.substr((line.begin(), point)), params['ch'])
+            if keyword is None:
+                return []
+            indent = previous_keyword_lookup(document, point,
+                                             *deindent_keywords[keyword])
+            if indent == -1:
+                return []
+
+        text = document.substr(line)
+        whitespace = len(text) - len(text.lstrip(' \t'))
+        if text[:whitespace] == ' ' * indent:
+            return []
+        # the indentation has the same length in all the position encodings
+        row = position['line']
+        return [{'range': {'start': {'line': row, 'character': 0},
+                           'end': {'line': row, 'character': whitespace}},
+                 'newText': ' ' * indent}]
+
+
+## command line
+
+# number of lines written at once
+WRITE_BUFFER_LINES = 4096
+
+# bumped when the indentation rules change, to discard cached results
+CHECK_CACHE_VERSION = 1
+
+
+def _split_indent(line):
+    """Return (indentation, rest of the line)."""
+    rest = line.lstrip(' \t')
+    return line[:len(line) - len(rest)], rest
+
+
+def reindent_lines(lines, tab_size=4, engine=None, shift=0):
+    """Yield the given lines reindented with the indentation rules.
+
+    Lines whose indentation is left free by the rules are shifted like the
+    block they belong to. Lines inside multi-line strings are not modified.
+
+    Arguments
+    ---------
+    lines: iterable of lines, with or without their end of line characters.
+    tab_size: tabs are count as 'tab_size' spaces (default 4).
+    engine: IndentationEngine in the state preceding the lines (default: at
+        the start of a file).
+    shift: shift of the lines outside of the blocks started in the lines.
+
+    """
+    if engine is None:
+        engine = IndentationEngine(tab_size)
+    # (old, new) indentation of the enclosing blocks
+    levels = [(0, shift)]
+    stmt_shift = shift
+    for line in lines:
+        whitespace, rest = _split_indent(line)
+        continuation = engine.continuation()
+        if continuation == 'string' or not rest.strip():
+            engine.feed(line.rstrip('\r\n'))
+            yield line
+            continue
+
+        old = get_line_current_indent(whitespace, tab_size)
+        if continuation == 'backslash':
+            new = max(0, old + stmt_shift)
+        elif continuation is None:
+            while levels[-1][0] > old:
+                levels.pop()
+            shifted = max(0, old - levels[-1][0] + levels[-1][1])
+            # the keywords are looked up with the shifted indentation
+            new = engine.expected_indent(' ' * shifted + rest, continuation)
+            if new is None:
+                new = shifted
+            if rest[0] != '#':
+                if levels[-1][0] == old:
+                    levels[-1] = (old, new)
+                else:
+                    levels.append((old, new))
+                stmt_shift = new - old
+        else:
+            new = engine.expected_indent(line, continuation)
+            shifted = max(0, old + stmt_shift)
+            if new is None:
+                new = old
+            elif new != shifted and engine.accepts_indent(line, shifted):
+                # the indentations allowed besides the expected one are
+                # kept, shifted with their statement
+                new = shifted
+
+        if new != old or whitespace.strip(' '):
+            line = ' ' * new + rest
+        engine.feed(line.rstrip('\r\n'))
+        yield line
+
+
+def check_lines(lines, tab_size=4):
+    """Yield (row, expected, found) for each misindented line.
+
+    row is the line number, starting at 1.
+    """
+    engine = IndentationEngine(tab_size)
+    for row, line in enumerate(lines, 1):
+        expected = engine.misindented(line.rstrip('\r\n'))
+        if expected is not None:
+            yield row, expected, get_line_current_indent(line, tab_size)
+
+
+def write_lines(lines, out):
+    """Write the lines to the file out, by chunks of WRITE_BUFFER_LINES.
+
+    Return the number of lines written.
+    """
+    count = 0
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) == WRITE_BUFFER_LINES:
+            out.write(''.join(buf))
+            count += len(buf)
+            del buf[:]
+    out.write(''.join(buf))
+    return count + len(buf)
+
+
+def iter_mapped_lines(mapped):
+    """Yield the lines of mapped (mmap.mmap or bytes), with their end of line
+    characters.
+
+    Only a line at a time is copied out of the mapped file: the memory used
+    does not depend on the size of the file.
+    """
+    find = mapped.find
+    start = 0
+    end = len(mapped)
+    while start < end:
+        stop = find(b'\n', start) + 1 or end
+        yield mapped[start:stop]
+        start = stop
+
+
+def iter_python_files(paths):
+    """Yield the python files found in paths, walking the directories."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    yield os.path.join(dirpath, filename)
+
+
+def check_file(job):
+    """Check the indentation of a file.
+
+    Arguments
+    ---------
+    job: tuple (path, tab_size, digest), digest being the content hash of the
+        cached result for this file, or None.
+
+    Return
+    ------
+    tuple (path, digest, misindented, error). misindented is the list of
+    (row, expected, found) of check_lines, or None if the content hash is
+    still digest. error is the error message if the file cannot be read.
+    """
+    # only used by the command line, not loaded in the plugin host
+    import hashlib
+    import mmap
+
+    path, tab_size, cached_digest = job
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                # the file is read through the mapping, never as a whole
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # empty files cannot be mapped
+                mapped = b''
+    except (IOError, OSError, ValueError) as e:
+        return path, None, None, str(e)
+    try:
+        digest = hashlib.sha1(mapped).hexdigest()
+        if digest == cached_digest:
+            return path, digest, None, None
+        lines = iter_mapped_lines(mapped)
+        if bytes is not str:
+            # python 3: the rules apply to text
+            lines = (line.decode('utf-8', 'replace') for line in lines)
+        misindented = list(check_lines(lines, tab_size))
+        return path, digest, misindented, None
+    finally:
+        if isinstance(mapped, mmap.mmap):
+            mapped.close()
+
+
+def load_check_cache(filename, tab_size):
+    """Return the {path: (digest, misindented)} results cached in filename.
+
+    An empty dict is returned if the file does not exist, cannot be parsed, or
+    was written for other indentation rules.
+    """
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if (not isinstance(cache, dict)
+            or cache.get('version') != CHECK_CACHE_VERSION
+            or cache.get('tab_size') != tab_size):
+        return {}
+    return dict((path, (entry[0], [tuple(l) for l in entry[1]]))
+                for path, entry in cache.get('files', {}).items())
+
+
+def save_check_cache(filename, tab_size, results):
+    """Write the {path: (digest, misindented)} results to filename."""
+    with open(filename, 'w') as f:
+        json.dump({'version': CHECK_CACHE_VERSION,
+                   'tab_size': tab_size,
+                   'files': results}, f, sort_keys=True)
+
+
+def check_paths(paths, tab_size=4, jobs=None, cache_filename=None):
+    """Check the indentation of the python files in paths.
+
+    The files are checked by a pool of jobs processes (one per cpu by
+    default). Files whose content hash matches a result of the cache file
+    cache_filename are not checked again. The results of this run are
+    merged into the cache file, which keeps the results of the other paths.
+
+    Return
+    ------
+    dict, JSON serializable report:
+        'files': {path: [{'line', 'expected', 'found'}, ...]} for each
+            misindented file,
+        'errors': {path: message} for each file that could not be read,
+        'checked', 'cached': number of files checked and found in the cache.
+    """
+    # only used by the command line, not loaded in the plugin host
+    import multiprocessing
+
+    cache = {}
+    if cache_filename:
+        cache = load_check_cache(cache_filename, tab_size)
+    job_list = [(path, tab_size, cache.get(path, (None,))[0])
+                for path in iter_python_files(paths)]
+
+    if jobs == 1 or len(job_list) <= 1:
+        pool = None
+        checked = (check_file(job) for job in job_list)
+    else:
+        jobs = jobs or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(jobs)
+        # a few chunks per process, to balance the load
+        chunksize = max(1, len(job_list) // (8 * jobs))
+        checked = pool.imap_unordered(check_file, job_list, chunksize)
+
+    report = {'files': {}, 'errors': {}, 'checked': 0, 'cached': 0}
+    results = dict(cache)
+    try:
+        for path, digest, misindented, error in checked:
+            if error is not None:
+                report['errors'][path] = error
+                results.pop(path, None)
+                continue
+            if misindented is None:
+                misindented = cache[path][1]
+                report['cached'] += 1
+            else:
+                report['checked'] += 1
+            results[path] = (digest, misindented)
+            if misindented:
+                report['files'][path] = [
+                    {'line': row, 'expected': expected, 'found': found}
+                    for row, expected, found in misindented]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if cache_filename:
+        save_check_cache(cache_filename, tab_size, results)
+    return report
+
+
+def main(argv=None):
+    """Command line entry point: reindent stdin to stdout."""
+    # not available in the python 2.6 of sublime text 2
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m python_indent',
+        description='Reindent python code read on stdin with PEP8 '
+                    'indentation rules.')
+    parser.add_argument('paths', nargs='*',
+                        help='files and directories to check (with --check); '
+                             'a JSON report is written on stdout')
+    parser.add_argument('--check', action='store_true',
+                        help='only print the numbers of the misindented lines')
+    parser.add_argument('--tab-size', type=int, default=4,
+                        help='number of spaces per indentation level '
+                             '(default 4)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of processes checking the files '
+                             '(default: number of cpus)')
+    parser.add_argument('--cache', metavar='FILE', default=None,
+                        help='file keeping the results of the previous '
+                             'checks, to skip unchanged files')
+    parser.add_argument('--server', action='store_true',
+                        help='run a language server on stdin and stdout, '
+                             'answering textDocument/onTypeFormatting')
+    args = parser.parse_args(argv)
+
+    if args.server:
+        return IndentServer(getattr(sys.stdin, 'buffer', sys.stdin),
+                            getattr(sys.stdout, 'buffer', sys.stdout),
+                            args.tab_size).serve()
+
+    if args.paths:
+        if not args.check:
+            parser.error('paths can only be given with --check')
+        report = check_paths(args.paths, args.tab_size, args.jobs, args.cache)
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return 1 if report['files'] or report['errors'] else 0
+
+    if args.check:
+        misindented = write_lines(
+            ('%d\n' % row for row, expected, found
+             in check_lines(sys.stdin, args.tab_size)),
+            sys.stdout)
+        return 1 if misindented else 0
+
+    write_lines(reindent_lines(sys.stdin, args.tab_size), sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
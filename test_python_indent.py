@@ -7,13 +7,31 @@
 """Test for python_indent.py using py.test library.
 """
 
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+from bisect import bisect_right
+
 import pytest
-from mock import patch, Mock
+try:
+    from unittest.mock import patch, Mock
+except ImportError:
+    from mock import patch, Mock
 
 import python_indent
+from python_indent import get_line_state_cache
 from python_indent import get_new_line_indent
-from python_indent import line_filter
+from python_indent import scan_line
 from python_indent import PythonDeindenter
+from python_indent import LineStateTracker
+from python_indent import invalidate_line_states
+from python_indent import iter_line_states
+from python_indent import reindent_lines
+from python_indent import check_lines
+from python_indent import check_paths
 
 
 class FakeRegion(object):
@@ -43,9 +61,21 @@ class FakeRegion(object):
         return "FakeRegion(%d,%d)" % (self._begin, self._end)
 
 
+class FakeSettings(dict):
+    """Mock for sublime.Settings."""
+    def add_on_change(self, key, on_change):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+
 class FakeView(str):
     """Mock for sublime.View."""
+    ids = python_indent.Document.ids
+
     def __init__(self, string, sel=None, tab_size=4):
+        self.id_ = next(self.ids)
         self.tab_size = tab_size
         self.string = string
         self.lines = string.split('\n')
@@ -60,28 +90,37 @@ class FakeView(str):
             self.sel_ = [FakeRegion(len(string), len(string))]
 
         self.commands = [(None, None, 1)]
+        self.syntax_score = 1
 
     def settings(self):
-        return {'tab_size': self.tab_size}
+        return FakeSettings(tab_size=self.tab_size)
+
+    def score_selector(self, point, selector):
+        return self.syntax_score
 
     def line(self, sel):
         if not isinstance(sel, FakeRegion):
             sel = FakeRegion(sel, sel)
 
-        for mark in self.line_marks:
-            if sel[0] >= mark:
-                line_start = mark
-            if sel[1] < mark:
-                line_stop = mark
-                break
+        marks = self.line_marks
+        line_start = marks[bisect_right(marks, sel[0]) - 1]
+        line_stop = marks[bisect_right(marks, sel[1])] - 1
         return FakeRegion(line_start, line_stop)
 
-
     def substr(self, line):
         if isinstance(line, FakeRegion):
-            return self.string[line.begin():line.end()].strip('\n')
+            return self.string[line.begin():line.end()]
         else:
-            return self.string[line[0]:line[1]].strip('\n')
+            return self.string[line[0]:line[1]]
+
+    def id(self):
+        return self.id_
+
+    def buffer_id(self):
+        return self.id_
+
+    def size(self):
+        return len(self.string)
 
     def sel(self):
         return self.sel_
@@ -328,6 +367,70 @@ def test_deindent_wrong_param():
         assert not mock.called
 
 
+def test_deindent_keyword():
+    """The deindenter looks up the keywords of the engine."""
+    deindenter = PythonDeindenter()
+    assert deindenter.deindent_keyword('    else:', ':') == 'else'
+    assert deindenter.deindent_keyword('    except ', ' ') == 'except'
+    assert deindenter.deindent_keyword('    except:', ':') == 'except'
+    assert deindenter.deindent_keyword('    elif:', ':') is None
+    assert deindenter.deindent_keyword('    finally', 'y') is None
+    assert sorted(python_indent.deindent_triggers) == sorted(
+        python_indent.deindent_keywords)
+
+def test_deindent_skip_comments():
+    """Blank and comment lines do not stop the keyword lookup."""
+    tests_blocks = [
+("""    if a:
+        b = 1
+# comment at column 0
+    else:""", 4),
+("""    try:
+        a = 8
+            # comment
+
+        except:""", 4),
+    ]
+
+    for block, indent in tests_blocks:
+        view = FakeView(block)
+        view.commands = ["insert", {"characters": block[-1]}, 1]
+
+        with patch.object(PythonDeindenter, 'change_indent', return_value=None) as mock:
+            PythonDeindenter().on_modified(view)
+
+        mock.assert_called_once_with(block.split('\n')[-1], indent)
+
+    lines = ['if a:', '    b = 1', '', '# comment', '      else:']
+    assert list(check_lines(lines)) == [(5, 0, 6)]
+
+
+def test_deindent_loop_else():
+    """'else' also aligns with the 'for' and 'while' loops."""
+    tests_blocks = [
+("""    for a in b:
+        if a:
+            break
+        b = a
+        else:""", 4),
+("""    while a:
+        a -= 1
+        else:""", 4),
+    ]
+
+    for block, indent in tests_blocks:
+        view = FakeView(block)
+        view.commands = ["insert", {"characters": block[-1]}, 1]
+
+        with patch.object(PythonDeindenter, 'change_indent', return_value=None) as mock:
+            PythonDeindenter().on_modified(view)
+
+        mock.assert_called_once_with(block.split('\n')[-1], indent)
+
+    lines = ['for a in b:', '    b = a', '        else:']
+    assert list(check_lines(lines)) == [(3, 0, 8)]
+
+
 def test_new_line_indent():
 
     tests_blocks = [
@@ -430,44 +533,1265 @@ def test_new_line_indent():
         assert get_new_line_indent(view, cursor) == indent
 
 
-def test_line_filter():
-    """Line_filter should remove comments and string."""
-    filter_line_test = [
-        ('func("a")', 'func("a")'),
-        ('func("a"', 'func("a"'),
-        ('func("("', 'func("_"'),
-        ('func(")"', 'func("_"'),
-        ('func("["', 'func("_"'),
-        ('func("]"', 'func("_"'),
-        ('func("{"', 'func("_"'),
-        ('func("}"', 'func("_"'),
-        ('func("(a)"', 'func("_a_"'),
-        ("func('(a)', ')'", "func('_a_', '_'"),
-        ("func('('", "func('_'"),
-        ("func('(a)', ')'", "func('_a_', '_'"),
-        (""" "('(')" """, """ "_'_'_" """),
-        (""" "(")"(" """, """ "_")"_" """),
-        (""" "(")'(' """, """ "_")'_' """),
-        ("""  "(')",("(",'(a)' """, """  "_'_",("_",'_a_' """),
-        (r'"(\")"', r'"_\"_"'),
-        (r'"(\\")', r'"_\\")'),
-        (r'"(\\\")"', r'"_\\\"_"'),
-        (r'"(\\\\")', r'"_\\\\")'),
-        (r'"(\\\\\")', r'"_\\\\\")'),  # limit of the escape-escaping
-        (r'"\"("', r'"\"_"'),
-        (r'"\\"("', r'"\\"("'),
-        ("some line  # with comments", "some line  "),
-        ("some line  # with # comments", "some line  "),
-        ("some line  #", "some line  "),
-        ("some line '#' with no comment", "some line '_' with no comment"),
-        ("#", ""),
-        ("# some comment", "")
-
-        # triple quote
-        # mixed quote
+def test_scan_line():
+    """scan_line should skip the brackets of strings, and the comments."""
+    # line, closing brackets, opening brackets, code length, open string
+    scan_line_test = [
+        ('func("a")', '', (), 9, None),
+        ('func("a"', '', (('(', 4),), 8, None),
+        ('func("("', '', (('(', 4),), 8, None),
+        ('func(")"', '', (('(', 4),), 8, None),
+        ('func("["', '', (('(', 4),), 8, None),
+        ('func("]"', '', (('(', 4),), 8, None),
+        ('func("{"', '', (('(', 4),), 8, None),
+        ('func("}"', '', (('(', 4),), 8, None),
+        ('func("(a)"', '', (('(', 4),), 10, None),
+        ("func('(a)', ')'", '', (('(', 4),), 15, None),
+        ("func('('", '', (('(', 4),), 8, None),
+        (""" "('(')" """, '', (), 9, None),
+        (""" "(")"(" """, ')', (), 9, None),
+        (""" "(")'(' """, ')', (), 9, None),
+        ("""  "(')",("(",'(a)' """, '', (('(', 8),), 19, None),
+        (r'"(\")"', '', (), 6, None),
+        (r'"(\\")', ')', (), 6, None),
+        (r'"(\\\")"', '', (), 8, None),
+        (r'"(\\\\")', ')', (), 8, None),
+        (r'"(\\\\\")', '', (), 9, None),  # escaped quote: unterminated string
+        (r'"\"("', '', (), 5, None),
+        (r'"\\"("', '', (('(', 4),), 6, None),
+        ("some line  # with comments", '', (), 11, None),
+        ("some line  # with # comments", '', (), 11, None),
+        ("some line  #", '', (), 11, None),
+        ("some line '#' with no comment", '', (), 29, None),
+        ("#", '', (), 0, None),
+        ("# some comment", '', (), 0, None),
+    ]
+    for line, closing, opening, length, string in scan_line_test:
+        assert scan_line(line)[2:] == (closing, opening, length, string)
+
+
+def test_new_line_indent_cached_states():
+    """Indentation computed from cached line states matches a fresh view."""
+    block = ('def f(a,\n'
+             '      b):\n'
+             '    c = [1,\n'
+             '         2,\n'
+             '         3]\n'
+             '    return (c,\n'
+             '            4)')
+    view = FakeView(block)
+    cursors = [view.line_marks[row + 1] - 1 for row in range(7)]
+    expected = [get_new_line_indent(FakeView(block), cursor)
+                for cursor in cursors]
+    assert expected == [6, 4, 9, 9, 4, 12, 0]
+    for cursor, indent in reversed(list(zip(cursors, expected))):
+        assert get_new_line_indent(view, cursor) == indent
+    for cursor, indent in zip(cursors, expected):
+        assert get_new_line_indent(view, cursor) == indent
+
+
+def test_new_line_indent_cache_invalidation():
+    """Cached line states following a modification are recomputed."""
+    view = FakeView('a = (1,\n     2,\n     3)')
+    assert get_new_line_indent(view, view.size()) == 0
+
+    new_block = 'a = 1\n     2,\n     3)'
+    view_id = view.id_
+    view.__init__(new_block)
+    view.id_ = view_id
+    view.sel_ = [FakeRegion(5, 5)]
+    view.commands = ['left_delete', None, 1]
+    LineStateTracker().on_modified(view)
+    assert get_new_line_indent(view, view.size()) == 0
+    assert get_new_line_indent(view, view.line_marks[2] - 1) == 5
+
+
+def test_new_line_indent_multiline_string():
+    """Brackets inside multi-line strings are ignored."""
+    tests_blocks = [
+        # inside the string: keep the indentation of the line
+        ('def f():\n    """Doc (', 4),
+        ('def f():\n    """Doc (\n      more [', 6),
+        ("sql = '''\n  select (", 2),
+        ('a = "abc \\\n  ( \\', 2),
+
+        # after the string
+        ('def f():\n    """Doc (\n    """', 4),
+        ('def f():\n    """Doc (\n    more ("""', 4),
+        ('    x = """(\n"""', 4),
+        ('    return """(\n"""', 0),
+        ('if x == """(\n""":', 4),
+        ('func(a, """(\n""",', 5),
+        ('func(a, """(\n"""', 5),
+        ('func(a, """(\n""")', 0),
+        ('a = "abc \\\n  (" + b', 0),
+        ("a = '''(''' + (", 4),
+        ('a = """ ""(" """', 0),
     ]
-    # test line filter
-    for input, output in filter_line_test:
-        assert line_filter(input) == output
 
+    for block, indent in tests_blocks:
+        view = FakeView(block)
+        assert get_new_line_indent(view, len(block)) == indent
 
+
+def test_scan_line_triple_quote():
+    """scan_line should handle triple-quoted strings on a line."""
+    scan_line_test = [
+        ('"""("""', '', (), 7, None),
+        ('"""a "(" b"""', '', (), 13, None),
+        ("'''a ')' b''' + (", '', (('(', 16),), 17, None),
+        ('"""(', '', (), 4, '"""'),
+    ]
+    for line, closing, opening, length, string in scan_line_test:
+        assert scan_line(line)[2:] == (closing, opening, length, string)
+
+
+def test_iter_line_states():
+    """Line states are computed forward from a list of lines."""
+    lines = [
+        ('def f(a,', (None, 0, 'block', None)),
+        ('      b):', (6, 1, None, 'bracket')),
+        ('    """Doc (', (4, 0, None, None)),
+        ('  text', (None, 0, None, 'string')),
+        ('    """', (None, 0, None, 'string')),
+        ('    if a:', (None, 0, 'block', None)),
+        ('        x = [1,', (8, 0, None, None)),
+        ('             2] + \\', (13, 1, None, 'bracket')),
+        ('            3', (None, 0, None, 'backslash')),
+        ('    else:', (4, 0, 'block', None)),
+        ('        return (', (8, 0, 'stop', None)),
+        ('            b)', (12, 1, None, 'bracket')),
+        ('', (None, 0, None, None)),
+        ('x = 1', (None, 0, None, None)),
+    ]
+    states = list(iter_line_states(line + '\n' for line, _ in lines))
+    assert states == [state for _, state in lines]
+
+
+def test_iter_line_states_new_line_indent():
+    """Continuation lines are expected where get_new_line_indent puts them."""
+    block = open(python_indent.__file__.rstrip('c')).read()
+    view = FakeView(block)
+    for row, state in enumerate(iter_line_states(block.split('\n'))):
+        if state.continuation == 'bracket' and state.indent is not None:
+            cursor = view.line_marks[row] - 1
+            assert get_new_line_indent(view, cursor) == state.indent
+
+
+def test_reindent_lines():
+    """Reindented lines follow the rules, free lines follow their block."""
+    block = [
+        'def f(a,\n',
+        '  b):\n',
+        '      x = [1,\n',
+        '  2]\n',
+        '      if x:\n',
+        '        y = 2\n',
+        '          # comment\n',
+        '\n',
+        '      else:\n',
+        '          y = 3\n',
+        '      s = """\n',
+        '  keep (\n',
+        '"""\n',
+        '      return y\n',
+        'z = 1\n',
+    ]
+    expected = [
+        'def f(a,\n',
+        '      b):\n',
+        '    x = [1,\n',
+        '         2]\n',
+        '    if x:\n',
+        '        y = 2\n',
+        '          # comment\n',
+        '\n',
+        '    else:\n',
+        '        y = 3\n',
+        '    s = """\n',
+        '  keep (\n',
+        '"""\n',
+        '    return y\n',
+        'z = 1\n',
+    ]
+    assert list(reindent_lines(block)) == expected
+    assert list(check_lines(block)) == [
+        (2, 6, 2), (3, 4, 6), (4, 11, 2), (6, 10, 8)]
+    assert list(check_lines(expected)) == []
+
+    # the indentations allowed besides the expected one are kept
+    for text in ['foo(\n    a,\n)\n',
+                 'if x:\n    foo = bar(\n            a,\n    )\n']:
+        lines = text.splitlines(True)
+        assert list(reindent_lines(lines)) == lines
+        assert list(check_lines(lines)) == []
+    # and shifted with their statement
+    assert list(reindent_lines(['if x:\n', '  foo(\n', '      a,\n',
+                                '  )\n'])) == [
+        'if x:\n', '    foo(\n', '        a,\n', '    )\n']
+
+
+def test_check_paths(tmpdir):
+    """Misindented lines are reported, unchanged files come from the cache."""
+    tmpdir.join('good.py').write('if x:\n    y = (1,\n         2)\n')
+    tmpdir.mkdir('pkg').join('bad.py').write('if x:\n  y = 1\n')
+    tmpdir.join('pkg', 'notes.txt').write('if x:\n  y = 1\n')
+    cache = str(tmpdir.join('cache.json'))
+    bad = str(tmpdir.join('pkg', 'bad.py'))
+
+    for jobs in (1, 2):
+        report = check_paths([str(tmpdir)], jobs=jobs, cache_filename=cache)
+        assert report['files'] == {
+            bad: [{'line': 2, 'expected': 4, 'found': 2}]}
+        assert report['errors'] == {}
+    assert (report['checked'], report['cached']) == (0, 2)
+
+    tmpdir.join('pkg', 'bad.py').write('if x:\n    y = 1\n')
+    report = check_paths([str(tmpdir)], jobs=1, cache_filename=cache)
+    assert report['files'] == {}
+    assert (report['checked'], report['cached']) == (1, 1)
+
+    # checking one file keeps the results of the others in the cache
+    report = check_paths([bad], jobs=1, cache_filename=cache)
+    assert (report['checked'], report['cached']) == (0, 1)
+    report = check_paths([str(tmpdir)], jobs=1, cache_filename=cache)
+    assert (report['checked'], report['cached']) == (0, 2)
+
+    report = check_paths([str(tmpdir)], tab_size=2, jobs=1,
+                         cache_filename=cache)
+    assert sorted(report['files']) == sorted([bad, str(tmpdir.join('good.py'))])
+    assert (report['checked'], report['cached']) == (2, 0)
+
+
+def test_benchmark_scenarios():
+    """The benchmark scenarios run and report their latencies."""
+    import bench_python_indent
+    results = bench_python_indent.run_benchmarks(repeat=3)
+    assert sorted(results) == sorted(
+        name for name, scenario in bench_python_indent.SCENARIOS)
+    for result in results.values():
+        assert 0 <= result['min_us'] <= result['median_us'] <= result['p99_us']
+
+
+def test_stats(tmpdir):
+    """Latencies and counters are recorded only when enabled."""
+    stats = python_indent.stats
+    block = "if a:\n    b = 1\n    else:"
+    view = FakeView(block)
+    view.commands = ["insert", {"characters": ":"}, 1]
+
+    PythonDeindenter().on_modified(view)
+    get_new_line_indent(view, len(block))
+    assert stats.to_dict() == {'counters': {}, 'histograms': {}}
+
+    stats.enabled = True
+    try:
+        PythonDeindenter().on_modified(view)
+        get_new_line_indent(FakeView(block), len(block))
+        counters = stats.to_dict()['counters']
+        histograms = stats.to_dict()['histograms']
+        assert counters == {'line state cache hits': 1,
+                            'line state cache misses': 1}
+        assert sum(histograms['PythonDeindenter.on_modified ms']['counts']) == 1
+        steps = histograms['previous_keyword_lookup steps']
+        assert steps['counts'][steps['bounds'].index(2)] == 1
+        assert histograms['line state lines scanned']['counts'][
+            steps['bounds'].index(2)] == 1
+        assert 'PythonDeindenter.on_modified ms: 1' in stats.format()
+
+        stats_file = tmpdir.join('stats.json')
+        python_indent.ShowPythonIndentStatsCommand().run(
+            file=str(stats_file), reset=True)
+        assert json.loads(stats_file.read())['counters'] == counters
+        assert stats.to_dict() == {'counters': {}, 'histograms': {}}
+    finally:
+        stats.enabled = False
+        stats.reset()
+
+
+def indent_rows(cache):
+    return dict((indent, list(rows))
+                for indent, rows in cache.indent_rows.items())
+
+
+def test_keyword_lookup_index():
+    """The lookup uses the indentation index, truncated on modifications."""
+    block = ("try:\n"
+             "    if a:\n"
+             "        b = 1\n"
+             "\n"
+             "    elif c:\n"
+             "        d = 2\n"
+             "    else:\n"
+             "        e = 3\n"
+             "except:")
+    view = FakeView(block)
+    lookup = python_indent.previous_keyword_lookup
+    assert lookup(view, len(block), ['try'], ['except']) == 0
+    cache = python_indent.line_state_caches[view.id()]
+    words = [python_indent.LINE_WORDS[c] for c in cache.word_codes[:4]]
+    assert list(cache.indents[:4]) == [0, 4, 8, -1]
+    assert words == ['try', 'if', '', '']
+    assert indent_rows(cache) == {0: [0], 4: [1, 4, 6], 8: [2, 5, 7]}
+
+    else_point = block.index('    else')
+    assert lookup(view, else_point, ['if'], ['elif']) == 4
+
+    invalidate_line_states(view, block.index('        b'))
+    assert len(cache.indents) == len(cache.word_codes) == 2
+    assert indent_rows(cache) == {0: [0], 4: [1], 8: []}
+    assert lookup(view, else_point, ['if'], ['elif']) == 4
+    assert indent_rows(cache) == {0: [0], 4: [1, 4], 8: [2, 5]}
+
+    # the lines continuing a string, a bracket or a backslash are not
+    # statements, as in check_lines
+    block = ('def f():\n'
+             '    if x:\n'
+             '        s = """\n'
+             'body at column 0\n'
+             '"""\n'
+             '        t = (1,\n'
+             '             2) + \\\n'
+             '3\n'
+             '    else:')
+    view = FakeView(block)
+    assert lookup(view, len(block), ['if'], ['elif']) == 4
+    cache = python_indent.line_state_caches[view.id()]
+    assert list(cache.indents) == [0, 4, 8, -1, -1, 8, -1, -1]
+    assert [row for row, expected, found
+            in check_lines(block.split('\n'))] == []
+    # past the time budget, from the nearest statement at column 0
+    view = FakeView(block.replace('\nbody', '\n    body')
+                    .replace('\n3', '\n    3'))
+    cache = get_line_state_cache(view)
+    with patch.object(cache, 'line_state', return_value=None):
+        assert lookup(view, len(view.string), ['if'], ['elif']) == 4
+
+
+def test_new_line_indent_chunked_scan():
+    """The view is read by exponentially growing chunks."""
+    block = "x = [\n" + "    1, 2, (3,\n           4),\n" * 500 + "    5"
+    expected = get_new_line_indent(FakeView(block), len(block))
+
+    view = FakeView(block)
+    with patch.object(python_indent, 'SCAN_CHUNK_SIZE', 16):
+        with patch.object(view, 'substr', wraps=view.substr) as substr:
+            assert get_new_line_indent(view, len(block)) == expected
+    # 2 ** 11 * 16 > len(block), plus the current line
+    assert substr.call_count <= 12
+
+
+class FakeSelection(list):
+    """Mock for sublime.RegionSet."""
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(region)
+
+
+class EditableFakeView(FakeView):
+    """FakeView applying the insertions and replacements."""
+    def __new__(cls, string, sel=None, tab_size=4):
+        return FakeView.__new__(cls, string)
+
+    def __init__(self, string, sel=None, tab_size=4):
+        FakeView.__init__(self, string, sel, tab_size)
+        self.sel_ = FakeSelection(self.sel_)
+        self.edits = []
+
+    def line_endings(self):
+        return 'Unix'
+
+    def insert(self, edit, point, text):
+        self.replace(edit, FakeRegion(point, point), text)
+
+    def replace(self, edit, region, text):
+        self.edits.append((region[0], region[1], text))
+        sel = self.sel_
+        FakeView.__init__(self, self.string[:region[0]] + text
+                          + self.string[region[1]:], tab_size=self.tab_size)
+        self.sel_ = sel
+
+
+def test_new_python_line_multi_cursor():
+    """All the cursors are handled in one pass, from the last one."""
+    block = "def f(a,\n      b):\n    x = 1"
+    cursors = [block.index(',') + 1, block.index(':') + 1,
+               block.index(' = 1'), block.index('= 1') + 1]
+    view = EditableFakeView(block, [(c, c) for c in reversed(cursors)])
+    command = python_indent.NewPythonLine()
+    command.view = view
+    command.run(None)
+
+    assert view.string == ("def f(a,\n      \n      b):\n    \n    x\n"
+                           "    =\n    1")
+    assert [e[0] for e in view.edits] == sorted(cursors, reverse=True)
+    assert [r[0] for r in view.sel()] == [15, 30, 41, 47]
+
+    view = EditableFakeView(block, [(1, 1), (2, 2), (len(block), len(block))])
+    command.view = view
+    command.run(None, full_line=True)
+    assert view.string == "def f(a,\n      \n      \n      b):\n    x = 1\n    "
+    assert [r[0] for r in view.sel()] == [15, 22, len(view.string)]
+
+
+def test_deindent_multi_selection():
+    """All the selections are deindented, non python views are skipped."""
+    block = ("if a:\n    b = 1\n    else:\n"
+             "try:\n    c = 2\n        except:\n"
+             "    d = 3")
+    cursors = [block.index('else:') + 5, block.index('except:') + 7,
+               len(block)]
+    view = FakeView(block)
+    view.sel_ = [FakeRegion(c, c) for c in cursors]
+    view.commands = ["insert", {"characters": ":"}, 1]
+
+    with patch.object(PythonDeindenter, 'change_indent', return_value='') as mock:
+        PythonDeindenter().on_modified(view)
+    assert mock.call_args_list == [(('        except:', 0),),
+                                   (('    else:', 0),)]
+
+    view = FakeView(block)
+    view.syntax_score = 0
+    view.command_history = Mock()
+    PythonDeindenter().on_modified(view)
+    assert not view.command_history.called
+
+
+def test_line_state_memory_budget():
+    """The line states stay within the memory budget."""
+    import bench_python_indent
+    code = bench_python_indent.mixed_code(200)
+    assert (bench_python_indent.line_state_bytes_per_line(code)
+            <= bench_python_indent.LINE_STATE_BYTES_BUDGET)
+
+
+def test_lookup_time_budget():
+    """Past the time budget, the lookups start from a column 0 statement."""
+    block = ("a = [\n" + "    1,\n" * 100 + "]\n"
+             "def f(a,\n      b):\n    if a:\n        c = 1\n    else:")
+    in_list = block.index("    1,\n" * 50) - 1
+    lookup = python_indent.previous_keyword_lookup
+    scan_cost = python_indent.scan_cost
+    view = FakeView(block)
+    with patch.object(python_indent, 'lookup_deadline', return_value=0.0):
+        with patch.object(scan_cost, 'check_interval', return_value=1):
+            assert get_new_line_indent(view, len(block)) == 8
+            assert get_new_line_indent(view, in_list) == 4
+            assert lookup(view, len(block), ['if'], ['elif']) == 4
+            # the scan resumes at each lookup
+            cache = python_indent.line_state_caches[view.id()]
+            assert 1 < len(cache.points) < block.count('\n')
+
+            # column 0 statement too far: only the current line is read
+            with patch.object(scan_cost, 'affordable', return_value=0):
+                assert get_new_line_indent(view, len(block)) == 8
+                assert lookup(view, len(block), ['if'], ['elif']) == -1
+
+    assert get_new_line_indent(view, len(block)) == 8
+    assert len(cache.points) == block.count('\n') + 1
+
+
+def test_load_settings():
+    """The settings are applied again when they change."""
+    settings = {'lookup_time_budget_ms': 0, 'instrumentation': True}
+    try:
+        with patch.object(python_indent, 'settings', settings):
+            python_indent.load_settings()
+            assert python_indent.LOOKUP_TIME_BUDGET is None
+            assert python_indent.stats.enabled
+            settings.update(lookup_time_budget_ms=20, instrumentation=False)
+            python_indent.load_settings()
+            assert python_indent.LOOKUP_TIME_BUDGET == 0.02
+            assert not python_indent.stats.enabled
+    finally:
+        python_indent.LOOKUP_TIME_BUDGET = 0.05
+
+
+def test_line_scan_cache():
+    """Scans are memoized for a bounded number of recently used lines."""
+    cache = python_indent.LineScanCache(4)
+    for line in ['pass', ')', 'pass', 'x = (', 'y', 'pass', 'z', 'w']:
+        assert cache.scan(line) == scan_line(line)
+    assert (cache.hits, cache.misses) == (2, 6)
+    assert len(cache) <= 4
+    assert ('pass', 4, None) in cache.current or ('pass', 4, None) in cache.previous
+    assert ('x = (', 4, None) not in cache.current
+
+    assert cache.scan('a"""', 4, '"""') == scan_line('a"""', 4, '"""')
+    assert cache.scan('a"""', 4, None) == scan_line('a"""', 4, None)
+    assert cache.misses == 8
+
+    cache.resize(0)
+    cache.scan('pass')
+    assert len(cache) == 0
+    assert cache.to_dict() == {'size': 0, 'lines': 0, 'hits': 2, 'misses': 9}
+
+
+def test_replay_view():
+    """ReplayView finds the lines as a view rebuilt after each edit."""
+    from bench_python_indent import ReplayView
+    rand = random.Random(0)
+    view = ReplayView("a\nbc\n\ndef\n")
+    for _ in range(300):
+        begin = rand.randint(0, view.size())
+        end = min(view.size(), begin + rand.choice([0, 0, 1, 3]))
+        view.replace(None, (begin, end), rand.choice(['', 'x', '\n', 'y\nz']))
+        expected = FakeView(view.text)
+        for point in range(view.size() + 1):
+            line = view.line(point)
+            assert (line[0], line[1]) == tuple(expected.line(point))
+            row, col = view.rowcol(point)
+            assert view.text_point(row, col) == point
+            assert row == view.text.count('\n', 0, point)
+
+
+def example_script():
+    """Return example.py, and its content as typed without indentation."""
+    with open(os.path.join(os.path.dirname(__file__), 'example.py')) as f:
+        example = f.read()
+    return example, ''.join(line.lstrip(' ')
+                            for line in example.splitlines(True))
+
+
+def test_replay_example():
+    """example.py is typed without pressing tab or backspace."""
+    from bench_python_indent import ReplayView, replay
+    example, script = example_script()
+    assert replay(ReplayView(''), script) == example
+    listeners = [LineStateTracker(), PythonDeindenter()]
+    assert replay(ReplayView(''), script, listeners) == example
+
+
+def test_replay_large_file():
+    """Editing sessions run on a 100k lines file."""
+    from bench_python_indent import ReplayView, replay, mixed_code
+    example, script = example_script()
+    code = mixed_code(5600)
+    assert code.count('\n') > 100000
+    view = ReplayView(code + '\n' + example)
+    view.sel_[0] = view.sel_[0].__class__(len(code), len(code))
+    text = replay(view, '\n' + script[:script.index('def barbaz')])
+    assert text.startswith(code + '\n' + example[:example.index('def barbaz')])
+
+
+def test_trace_replay(tmpdir):
+    """A recorded editing session is replayed offline to the same buffers."""
+    from bench_python_indent import ReplayView, replay, replay_trace
+    example, script = example_script()
+    trace_file = str(tmpdir.join('trace.jsonl'))
+    settings = {'trace_file': trace_file}
+    try:
+        with patch.object(python_indent, 'settings', settings):
+            python_indent.load_settings()
+            view = ReplayView('')
+            replay(view, script[:script.index('def barbaz')])
+            # modified outside of the recorded commands
+            view.replace(None, (0, 0), '# header\n')
+            replay(view, script[script.index('def barbaz'):])
+            assert view.text == '# header\n' + example
+            settings['trace_file'] = ''
+            python_indent.load_settings()
+    finally:
+        python_indent.trace_recorder.close()
+
+    with open(trace_file) as f:
+        events = [json.loads(line) for line in f]
+    assert [e['op'] for e in events[:2]] == ['start', 'view']
+    deltas = [e['delta'] for e in events[2:]]
+    # only the typed character is recorded for each keystroke, but for the
+    # one following the header
+    assert len([text for begin, end, text in deltas if len(text) > 1]) == 1
+    latencies, live, diverged = replay_trace(events)
+    assert diverged == 0
+    assert len(latencies['new_line']) == example.count('\n')
+    assert len(latencies['modified']) == len(script)
+    assert len(live['modified']) == len(latencies['modified'])
+
+
+def paste(string, text, sel=None):
+    """Paste text in an EditableFakeView of string, at the end by default."""
+    if sel is None:
+        sel = [(len(string), len(string))]
+    view = EditableFakeView(string, sel)
+    command = python_indent.PastePythonLines()
+    command.view = view
+    with patch.object(python_indent.sublime, 'get_clipboard', create=True,
+                      return_value=text):
+        command.run(None)
+    return view
+
+
+def test_paste_python_lines():
+    """Pasted lines are reindented for the insertion point."""
+    block = "class A:\n    def f(self):\n        if x:\n"
+    view = paste(block, "for i in y:\n    if i:\n        pass\n"
+                        "    else:\n        break\nreturn 1\n")
+    assert view.string == block + (
+        "            for i in y:\n                if i:\n"
+        "                    pass\n                else:\n"
+        "                    break\n            return 1\n")
+    # one replacement, the cursor after the pasted text
+    assert len(view.edits) == 1
+    assert [r[0] for r in view.sel()] == [len(view.string)]
+
+    # copied from a nested block, with a multi-line string
+    view = paste("x = 1\n", '        s = """\n    a\n"""\n        t = (1,\n'
+                            '   2)\n    u = 3\n')
+    assert view.string == ('x = 1\ns = """\n    a\n"""\nt = (1,\n     2)\n'
+                           'u = 3\n')
+
+    # aligned with a block before the insertion point
+    view = paste("if a:\n    x = 1\n", "else:\n    y = 2\n")
+    assert view.string == "if a:\n    x = 1\nelse:\n    y = 2\n"
+
+    # after some text, the first line is kept
+    view = paste("x = ", "foo(a,\nb)\n")
+    assert view.string == "x = foo(a,\n        b)\n"
+
+    # in the indentation of a line, which keeps its indentation
+    block = "def f():\n    x = 1\n"
+    view = paste(block, "y = 2\n", [(13, 13)])
+    assert view.string == "def f():\n    y = 2\n    x = 1\n"
+    assert [r[0] for r in view.sel()] == [23]
+    view = paste(block, "  y = 2\n", [(11, 11)])
+    assert view.string == "def f():\n  y = 2\n    x = 1\n"
+    view = paste(block + "\n  ", "y = 2")
+    assert view.string == block + "\n  y = 2"
+
+
+def test_paste_python_lines_multi_cursor():
+    """Each selection is replaced by the pasted lines, from the last one."""
+    block = "if a:\n    x\nelse:\n    y"
+    cursors = [block.index('x'), block.index('y')]
+    view = paste(block, "z = 1\nif z:\nw = 2", [(c, c + 1) for c in cursors])
+    assert view.string == ("if a:\n    z = 1\n    if z:\n        w = 2\n"
+                           "else:\n    z = 1\n    if z:\n        w = 2")
+    assert [e[0] for e in view.edits] == [18, 6]
+    assert [r[0] for r in view.sel()] == [39, len(view.string)]
+
+
+def lsp_messages(*messages):
+    """Return the messages framed with their Content-Length header."""
+    data = b''
+    for message in messages:
+        body = json.dumps(message).encode('utf-8')
+        data += b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n'
+        data += body
+    return data
+
+
+def lsp_responses(data):
+    """Return the messages of the output of the server."""
+    stream = io.BytesIO(data)
+    server = python_indent.IndentServer(stream, None)
+    responses = []
+    while True:
+        message = server.read_message()
+        if message is None:
+            return responses
+        responses.append(message)
+
+
+def test_indent_server():
+    """Documents are kept up to date by incremental changes."""
+    uri = 'file:///a.py'
+
+    def change(line, character, end_line, end_character, text):
+        return {'method': 'textDocument/didChange', 'params': {
+            'textDocument': {'uri': uri}, 'contentChanges': [{
+                'range': {'start': {'line': line, 'character': character},
+                          'end': {'line': end_line,
+                                  'character': end_character}},
+                'text': text}]}}
+
+    def on_type(id, line, character, ch):
+        return {'id': id, 'method': 'textDocument/onTypeFormatting',
+                'params': {'textDocument': {'uri': uri}, 'ch': ch,
+                           'position': {'line': line,
+                                        'character': character},
+                           'options': {'tabSize': 4, 'insertSpaces': True}}}
+
+    output = io.BytesIO()
+    server = python_indent.IndentServer(io.BytesIO(lsp_messages(
+        {'id': 1, 'method': 'initialize', 'params': {}},
+        {'method': 'initialized', 'params': {}},
+        {'method': 'textDocument/didOpen', 'params': {'textDocument': {
+            'uri': uri, 'languageId': 'python', 'version': 1,
+            'text': 'def f(a,\r\n      b):\r\n    if a:\r\n'}}},
+        # new line after 'x = (1,'
+        change(3, 0, 3, 0, '        x = (1,\n'),
+        on_type(2, 4, 0, '\n'),
+        change(4, 0, 4, 0, ' ' * 13 + '2)\n        else:'),
+        on_type(3, 5, 13, ':'),
+        change(5, 0, 5, 4, ''),
+        on_type(4, 5, 5, ':'),
+        {'id': 5, 'method': 'textDocument/hover', 'params': {}},
+        {'id': 6, 'method': 'shutdown'},
+        {'method': 'exit'})), output)
+    assert server.serve() == 0
+
+    responses = lsp_responses(output.getvalue())
+    assert responses[0]['result']['capabilities'][
+        'documentOnTypeFormattingProvider']['firstTriggerCharacter'] == '\n'
+    assert [r['id'] for r in responses] == [1, 2, 3, 4, 5, 6]
+    assert responses[1]['result'] == [
+        {'range': {'start': {'line': 4, 'character': 0},
+                   'end': {'line': 4, 'character': 0}},
+         'newText': ' ' * 13}]
+    assert responses[2]['result'] == [
+        {'range': {'start': {'line': 5, 'character': 0},
+                   'end': {'line': 5, 'character': 8}},
+         'newText': ' ' * 4}]
+    # already deindented
+    assert responses[3]['result'] == []
+    assert responses[4]['error']['code'] == -32601
+
+    document = server.documents[uri]
+    assert document.text == ('def f(a,\n      b):\n    if a:\n'
+                             '        x = (1,\n             2)\n    else:')
+    # the line states before the changes are still cached
+    assert len(get_line_state_cache(document).points) > 1
+
+
+def test_indent_server_position_encoding():
+    """Positions count UTF-16 code units, unless the client accepts
+    'utf-32'."""
+    uri = 'file:///a.py'
+    text = u"x = '\U0001f600' + y\n"
+    for encodings, end in (([], 12), (['utf-32', 'utf-16'], 11)):
+        output = io.BytesIO()
+        server = python_indent.IndentServer(io.BytesIO(lsp_messages(
+            {'id': 1, 'method': 'initialize', 'params': {'capabilities': {
+                'general': {'positionEncodings': encodings}}}},
+            {'method': 'textDocument/didOpen', 'params': {'textDocument': {
+                'uri': uri, 'languageId': 'python', 'version': 1,
+                'text': text}}},
+            # ' + y' replaced after the closing quote
+            {'method': 'textDocument/didChange', 'params': {
+                'textDocument': {'uri': uri}, 'contentChanges': [{
+                    'range': {'start': {'line': 0, 'character': end - 4},
+                              'end': {'line': 0, 'character': end}},
+                    'text': ' + (1,'}]}},
+            {'id': 2, 'method': 'textDocument/onTypeFormatting',
+             'params': {'textDocument': {'uri': uri}, 'ch': '\n',
+                        'position': {'line': 1, 'character': 0}}})),
+            output)
+        server.serve()
+        responses = lsp_responses(output.getvalue())
+        assert responses[0]['result']['capabilities'][
+            'positionEncoding'] == ('utf-32' if encodings else 'utf-16')
+        assert server.documents[uri].text == u"x = '\U0001f600' + (1,\n"
+        assert responses[1]['result'][0]['newText'] == ' ' * 11
+
+
+def test_indent_server_stdio():
+    """The server is started with --server, and stops at the end of its
+    input."""
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'python_indent', '--server'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    output = process.communicate(lsp_messages(
+        {'id': 1, 'method': 'initialize', 'params': {}}))[0]
+    assert process.returncode == 1
+    assert lsp_responses(output)[0]['id'] == 1
+
+
+# check a file in a new process, printing the growth of its anonymous
+# memory (RssAnon) at each misindented line
+CHECK_FILE_MEMORY_SCRIPT = """
+import sys
+import python_indent
+
+def anonymous_memory():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1])
+
+check_lines = python_indent.check_lines
+
+def sampled_check_lines(lines, tab_size):
+    for misindented in check_lines(lines, tab_size):
+        print(anonymous_memory() - before)
+        yield misindented
+
+python_indent.check_lines = sampled_check_lines
+before = anonymous_memory()
+python_indent.check_file((sys.argv[1], 4, None))
+"""
+
+
+@pytest.mark.skipif("not os.path.exists('/proc/self/status')")
+def test_check_file_memory(tmpdir):
+    """Large files are checked in constant memory."""
+    from bench_python_indent import mixed_code
+    path = tmpdir.join('big.py')
+    block = (mixed_code(10) + ('# %s\n' % ('-' * 2000)) * 150
+             + 'if x:\n  y = 1\n')
+    with open(str(path), 'w') as f:
+        for _ in range(40):
+            f.write(block)
+    assert path.size() > 10 * 1024 * 1024
+
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHECK_FILE_MEMORY_SCRIPT, str(path)],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    growth = [int(kb) for kb in output.split()]
+    assert len(growth) == 40
+    assert max(growth) < 1024
+
+    # empty files cannot be mapped
+    tmpdir.join('empty.py').write('')
+    assert python_indent.check_file((str(tmpdir.join('empty.py')), 4, None))[
+        2:] == ([], None)
+
+
+def test_indent_checker():
+    """Misindented lines are checked again until the engine converges."""
+    from bench_python_indent import mixed_code
+    lines = mixed_code(1000).split('\n')
+    lines[9013] = '   ' + lines[9013]
+    document = python_indent.Document('\n'.join(lines))
+    checker = python_indent.IndentChecker(4)
+
+    def check(first_row, last_row):
+        start, end, changed = checker.update(document, first_row, last_row)
+        assert list(checker.misindented) == [
+            row - 1 for row, expected, found
+            in check_lines(document.text.split('\n'))]
+        return end - start, changed
+
+    assert check(0, len(lines)) == (len(lines), True)
+    assert list(checker.misindented) == [9013]
+
+    def edit(row, col, end_col, text):
+        point = document.text_point(row, col)
+        document.edit(point, document.text_point(row, end_col), text)
+        return check(row, document.rowcol(point + len(text))[0])
+
+    # typing in a statement, or adding lines
+    checked, changed = edit(5000, 12, 12, 'x')
+    assert checked <= 2 * python_indent.CHECKPOINT_LINES and not changed
+    checked, changed = edit(5000, 0, 0, 'y = 1\nz = 2\n')
+    assert checked <= 2 * python_indent.CHECKPOINT_LINES and not changed
+    assert list(checker.misindented) == [9015]
+    # fixing the misindented line
+    assert edit(9015, 0, 3, '')[1]
+    assert list(checker.misindented) == []
+    # an open bracket changes all the following lines, until it is closed
+    checked, changed = edit(100, 0, 0, '(')
+    assert checked > len(lines) / 2 and changed
+    checked, changed = edit(100, 0, 1, '')
+    assert checked > len(lines) / 2 and changed
+    assert list(checker.misindented) == []
+
+    # modifications that cannot be located otherwise (undo...)
+    last = document.rowcol(document.size())[0]
+    for row, col, end_col, text in [(300, 4, 4, 'x'), (7000, 0, 0, 'a\nb\n'),
+                                    (21, 0, 4, ''), (last + 2, 0, 0, 'c')]:
+        point = document.text_point(row, col)
+        document.edit(point, document.text_point(row, end_col), text)
+        first_row, last_row = checker.locate(document)
+        assert (row - python_indent.CHECKPOINT_LINES < first_row <= row
+                <= last_row < row + 2 * python_indent.CHECKPOINT_LINES)
+        check(first_row, last_row)
+
+    # a check running out of time stops at a pending row
+    lines = document.text.split('\n')
+    checker = python_indent.IndentChecker(4)
+    checker.update(document, 0, len(lines), -1)
+    while checker.pending < 5000:
+        checker.resume(document, -1)
+    pending = checker.pending
+    assert list(checker.misindented) == []
+
+    def edit_pending(row, col, end_col, text):
+        point = document.text_point(row, col)
+        document.edit(point, document.text_point(row, end_col), text)
+        return checker.update(document, row,
+                              document.rowcol(point + len(text))[0])
+
+    # the modifications converge before the pending row, and the ones past
+    # it are left to resume
+    start, end, changed = edit_pending(100, 12, 12, 'x')
+    assert end - start <= 2 * python_indent.CHECKPOINT_LINES
+    start, end, changed = edit_pending(100, 0, 0, 'y = 1\n')
+    assert end - start <= 2 * python_indent.CHECKPOINT_LINES
+    assert checker.pending == pending + 1
+    assert edit_pending(pending + 100, 0, 0, '(') == (pending + 100,) * 2 + (
+        False,)
+    # the lines after an unclosed bracket are checked up to the pending row
+    start, end, changed = edit_pending(200, 0, 0, '(')
+    assert end == checker.pending == pending + 1 and changed
+    checker.resume(document)
+    assert checker.pending is None
+    assert list(checker.misindented) == [
+        row - 1 for row, expected, found
+        in check_lines(document.text.split('\n'))]
+
+
+def test_check_lines_brackets():
+    """The indentations of bracket continuations allowed by PEP 8 besides
+    the expected one are not reported."""
+    lines = [
+        'foo = bar(',
+        '    a,',
+        ')',
+        'foo = bar(  # comment',
+        '        a,',
+        '    )',
+        'x = [1,',
+        '     2,',
+        '    ]',
+        'if (a',
+        '        and b):',
+        '    pass',
+        'foo = bar(a,',
+        '  b)',
+        'foo = bar(',
+        'a)',
+        'foo = bar(c(',
+        '            a),',
+        '          b,',
+        '  )',
+    ]
+    assert list(check_lines(lines)) == [(14, 10, 2), (16, 4, 0), (20, 10, 2)]
+
+    # the brackets opened before a snapshot of the checker
+    lines = ['x = {'] + ['    %d: 0,' % i for i in range(100)] + ['}']
+    document = python_indent.Document('\n'.join(lines))
+    checker = python_indent.IndentChecker(4)
+    checker.update(document, 0, len(lines))
+    assert list(checker.misindented) == []
+    point = document.text_point(70, 4)
+    document.edit(point, point, '1')
+    checker.update(document, 70, 70)
+    assert list(checker.misindented) == []
+
+
+def test_misindentation_markers():
+    """The gutter markers follow the modifications of the view."""
+    from bench_python_indent import ReplayView, replay
+    view = ReplayView('if a:\n  b = 1\n')
+    view.add_regions = Mock()
+    markers = python_indent.MisindentationMarkers()
+    timeouts = []
+    with patch.multiple(python_indent.sublime, create=True, DRAW_EMPTY=1,
+                        DRAW_OUTLINED=2,
+                        set_timeout=lambda f, delay: timeouts.append(f)), \
+            patch.object(python_indent, 'misindentation_markers', True):
+        markers.on_activated(view)
+        regions = view.add_regions.call_args[0][1]
+        assert [tuple(r) for r in regions] == [(6, 13)]
+
+        # checked once the user stops typing
+        view.add_regions.reset_mock()
+        view.sel_[0] = view.sel_[0].__class__(6, 6)
+        replay(view, '  ', [markers])
+        assert len(timeouts) == 2 and not view.add_regions.called
+        with patch.object(python_indent.IndentChecker, 'update') as update:
+            timeouts.pop(0)()
+            assert not update.called
+        timeouts.pop(0)()
+        assert view.add_regions.call_args[0][1] == []
+        # unchanged markers are not drawn again
+        view.add_regions.reset_mock()
+        view.sel_[0] = view.sel_[0].__class__(15, 15)
+        replay(view, ' + 2\nc = 3', [markers])
+        timeouts.pop()()
+        assert view.text == 'if a:\n    b = 1 + 2\n    c = 3\n'
+        assert not view.add_regions.called
+    markers.on_close(view)
+    assert view.id() not in python_indent.indent_checkers
+
+
+def test_background_indexing():
+    """The views are indexed by slices, the active view first, and the
+    scan pauses while the user is typing."""
+    from bench_python_indent import mixed_code
+    text = mixed_code(200)
+    views = [FakeView(text), FakeView(text)]
+    scheduler = python_indent.IndexScheduler()
+    set_timeout = Mock()
+    scan_cost = python_indent.scan_cost
+
+    def cached_rows(view):
+        cache = python_indent.line_state_caches.get(view.id())
+        return len(cache.points) - 1 if cache else 0
+
+    with patch.object(python_indent.sublime, 'set_timeout', set_timeout,
+                      create=True):
+        scheduler.add(views[0])
+        scheduler.add(views[1], active=True)
+        assert scheduler.views == [views[1], views[0]]
+        assert set_timeout.call_count == 1
+
+        # one slice per call, until the active view is indexed
+        with patch.object(python_indent, 'INDEX_SLICE', 0.0):
+            with patch.object(scan_cost, 'check_interval', return_value=1):
+                scheduler.run()
+                assert 0 < cached_rows(views[1]) < text.count('\n')
+                while scheduler.views[0] is views[1]:
+                    scheduler.run()
+        assert cached_rows(views[1]) == text.count('\n')
+        assert cached_rows(views[0]) == 0
+
+        # typing pauses the scan
+        set_timeout.reset_mock()
+        scheduler.modified(views[1])
+        scheduler.run()
+        assert cached_rows(views[0]) == 0
+        delay = set_timeout.call_args[0][1]
+        assert 0 < delay <= python_indent.INDEX_IDLE_DELAY * 1000
+
+        with patch.object(python_indent, 'INDEX_IDLE_DELAY', 0.0):
+            while scheduler.views:
+                scheduler.run()
+    assert cached_rows(views[0]) == text.count('\n')
+    # the first new line finds the line states cached
+    cache = python_indent.line_state_caches[views[0].id()]
+    points = len(cache.points)
+    assert get_new_line_indent(views[0], len(text)) == 0
+    assert len(cache.points) == points
+
+
+def test_buffer_caches():
+    """The caches are shared by the clones of a view, and the least
+    recently used buffers are evicted past the memory budget."""
+    from bench_python_indent import mixed_code
+    text = mixed_code(100)
+    views = [FakeView(text) for i in range(3)]
+    clone = FakeView(text)
+    clone.buffer_id = views[0].id
+    caches = python_indent.line_state_caches
+    buffer_caches = python_indent.buffer_caches
+
+    def index(view):
+        get_line_state_cache(view).line_state(view, len(text))
+
+    index(views[0])
+    assert get_line_state_cache(clone) is caches[views[0].id()]
+    size = caches[views[0].id()].memory()
+    assert 0 < size < 2 * len(text) * 100
+
+    with patch.object(buffer_caches, 'budget', int(2.5 * size)):
+        index(views[1])
+        index(views[2])
+        # the size of the scanned lines is accounted on the next use
+        assert views[0].id() in caches
+        get_line_state_cache(views[2])
+        assert views[0].id() not in caches
+        assert views[1].id() in caches
+        # evicted buffers are scanned again on their next use
+        assert get_new_line_indent(clone, len(text) - 2) == 16
+        index(views[0])
+        assert len(caches[views[0].id()].points) == text.count('\n') + 1
+        get_line_state_cache(views[0])
+        assert views[1].id() not in caches and views[2].id() in caches
+
+    tracker = LineStateTracker()
+    tracker.on_close(clone)
+    assert views[0].id() in caches
+    for view in views:
+        tracker.on_close(view)
+        assert view.id() not in caches
+        assert view.buffer_id() not in buffer_caches.sizes
+
+
+def test_async_events():
+    """With sublime text 3 events, the edits go through text commands, and
+    the markers and the indexing are updated off the main thread."""
+    from bench_python_indent import ReplayView, replay, mixed_code
+    block = "if a:\n    b = 1\n    else:"
+    view = EditableFakeView(block)
+    view.commands = ["insert", {"characters": ":"}, 1]
+    view.run_command = Mock()
+    with patch.multiple(python_indent, ASYNC_EVENTS=True):
+        PythonDeindenter().on_modified(view)
+        command, args = view.run_command.call_args[0]
+        assert command == 'deindent_python_lines'
+        assert args == {'edits': [(16, 25, 'else:')]}
+        deindent = python_indent.DeindentPythonLines()
+        deindent.view = view
+        deindent.run(None, **args)
+        assert view.string == "if a:\n    b = 1\nelse:"
+        view.sel_ = [FakeRegion(21, 21)]
+        assert python_indent.modified_range(view, command, args) == (16, 21)
+
+    text = mixed_code(100)
+    lines = text.split('\n')
+    view = ReplayView(text)
+    view.add_regions = Mock()
+    markers = python_indent.MisindentationMarkers()
+    set_timeout = Mock()
+    with patch.multiple(python_indent, ASYNC_EVENTS=True,
+                        misindentation_markers=True):
+        with patch.multiple(python_indent.sublime, create=True, DRAW_EMPTY=1,
+                            DRAW_OUTLINED=2, set_timeout_async=set_timeout):
+            markers.on_activated(view)
+            assert not view.add_regions.called
+            markers.on_activated_async(view)
+            assert view.add_regions.call_args[0][1] == []
+
+            # two modifications before the asynchronous event
+            view.add_regions.reset_mock()
+            region = view.sel_[0].__class__
+            view.sel_[0] = region(*[view.text_point(500, 8)] * 2)
+            replay(view, '  ', [markers])
+            view.sel_[0] = region(*[view.text_point(20, 0)] * 2)
+            replay(view, 'x = 1\n', [markers])
+            assert not view.add_regions.called
+            markers.on_modified_async(view)
+            assert view.add_regions.called
+            checker = python_indent.indent_checkers[view.buffer_id()]
+            assert list(checker.misindented) == [
+                row - 1 for row, expected, found
+                in check_lines(view.text.split('\n'))] == [501, 502]
+
+            scheduler = python_indent.IndexScheduler()
+            scheduler.add(view)
+            assert set_timeout.call_args[0][0] == scheduler.run
+    markers.on_close(view)
+
+
+@pytest.mark.skipif("sys.version_info[0] < 3")
+def test_cache_lock():
+    """The line states are scanned and invalidated by another thread while
+    the lookups run."""
+    import threading
+    from bench_python_indent import mixed_code
+    text = mixed_code(300)
+    view = FakeView(text)
+    points = [m - 1 for m in view.line_marks[1:-1:97]]
+    expected = [get_new_line_indent(FakeView(text), p) for p in points]
+    view.commands = (None, None, 1)
+    scheduler = python_indent.IndexScheduler()
+    tracker = LineStateTracker()
+    done = []
+
+    def index():
+        while not done:
+            tracker.on_modified(view)
+            scheduler.add(view)
+            while scheduler.views:
+                scheduler.run()
+
+    # switch between the threads as often as possible
+    if hasattr(sys, 'setswitchinterval'):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+    else:
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+    with patch.multiple(python_indent, run_later=Mock(), INDEX_IDLE_DELAY=0):
+        thread = threading.Thread(target=index)
+        thread.start()
+        try:
+            for i in range(20):
+                found = [get_new_line_indent(view, p) for p in points]
+                assert found == expected
+        finally:
+            done.append(True)
+            thread.join()
+            if hasattr(sys, 'setswitchinterval'):
+                sys.setswitchinterval(interval)
+            else:
+                sys.setcheckinterval(interval)
+
+
+@pytest.mark.skipif("sys.version_info[0] < 3")
+def test_checker_lock():
+    """The lookups and the modifications of the main thread do not wait for
+    the check of the misindented lines."""
+    import threading
+    from bench_python_indent import ReplayView, mixed_code
+    text = mixed_code(100)
+    view = ReplayView(text)
+    view.add_regions = Mock()
+    markers = python_indent.MisindentationMarkers()
+    checking = threading.Event()
+    checked = threading.Event()
+
+    def update(*args):
+        checking.set()
+        checked.wait(5)
+        return 0, 0, False
+
+    with patch.object(python_indent.IndentChecker, 'update', update):
+        with patch.multiple(python_indent, ASYNC_EVENTS=True,
+                            misindentation_markers=True), \
+                patch.multiple(python_indent.sublime, create=True,
+                               DRAW_EMPTY=1, DRAW_OUTLINED=2):
+            thread = threading.Thread(target=markers.on_activated_async,
+                                      args=(view,))
+            thread.start()
+            try:
+                assert checking.wait(5)
+                # the check holds checker_lock, and not cache_lock
+                assert get_new_line_indent(view, len(text)) == 0
+                view.command = ('insert', {'characters': 'x'}, 1)
+                markers.on_modified(view)
+                LineStateTracker().on_modified(view)
+                assert thread.is_alive()
+            finally:
+                checked.set()
+                thread.join()
+    markers.on_close(view)
+
+
+@pytest.mark.skipif("sys.version_info[0] < 3")
+def test_modified_listeners_lock():
+    """The modifications of the views without line states, python or not,
+    do not wait for the background indexing."""
+    import threading
+    from bench_python_indent import BenchView
+    view = BenchView('x = 1\n', command=('insert', {'characters': ':'}, 1))
+    view.score_selector = Mock(return_value=0)
+    listeners = (PythonDeindenter(), LineStateTracker(),
+                 python_indent.MisindentationMarkers())
+    done = threading.Event()
+
+    def modify():
+        for listener in listeners:
+            listener.on_modified(view)
+        done.set()
+
+    with python_indent.cache_lock:
+        thread = threading.Thread(target=modify)
+        thread.start()
+        assert done.wait(5)
+    thread.join()
+    python_indent.python_views.pop(view.id(), None)
+
+
+def test_corpus_benchmark(tmpdir):
+    """The rules agree with the indentation derived from the tokens."""
+    import bench_python_indent
+    text = ('def f(a,\n'
+            '      b):\n'
+            '    x = [\n'
+            '        1,\n'
+            '        2,\n'
+            '    ]\n'
+            '    if x:\n'
+            '        return x\n'
+            '    y = 1\n'
+            '    pass\n')
+    assert bench_python_indent.tokenize_expectations(text) == {
+        0: ('visual', 6), 1: ('block', 4), 2: ('hanging', 8),
+        3: ('hanging', 8), 5: ('statement', 4), 6: ('block', 8),
+        7: ('stop', 4), 8: ('statement', 4)}
+
+    tmpdir.join('snippet.py').write(text)
+    tmpdir.join('invalid.py').write('def f(:\n')
+    with open(os.path.join(os.path.dirname(__file__), 'example.py')) as f:
+        tmpdir.join('example.py').write(f.read())
+    results = bench_python_indent.corpus_benchmark([str(tmpdir)])
+    assert (results['files'], results['skipped']) == (2, 1)
+    assert results['agreement']['block'][0] > 0
+    for lines, agreeing in results['agreement'].values():
+        assert agreeing >= 0.9 * lines
+    assert 'total' in bench_python_indent.format_corpus_results(results)